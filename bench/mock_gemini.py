@@ -0,0 +1,232 @@
+"""
+Local stand-in for the Gemini generateContent / streamGenerateContent endpoints.
+Used by run_bench.py; can also be run on its own and the app or CLI pointed at it:
+
+    python bench/mock_gemini.py --port 8765 --image-latency 2 --error-rate 0.02 --rpm 60
+    GEMINI_API_BASE=http://127.0.0.1:8765/v1beta streamlit run scenebuilder.py
+
+Text requests that contain <P1>..<Pn> passages get a breakdown back (scenes_per_passage
+scenes per passage, with "part" set), any other text request gets a short prompt.
+Image requests get a noise image of the configured size; every response is made unique
+(a PNG text chunk / JPEG comment) so content-addressed storage can't deduplicate them.
+"""
+import argparse
+import base64
+import io
+import json
+import random
+import re
+import threading
+import time
+from collections import defaultdict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+PASSAGE = re.compile(r'<P(\d+)>\n(.*?)(?=\n\n<P\d+>|""")', re.S)
+
+class MockConfig:
+    """Behaviour of the mock server; every field can be changed while it runs"""
+
+    def __init__(self, latency=0.05, image_latency=0.2, jitter=0.5, error_rate=0.0, rpm=0,
+                 image_size=(1024, 576), image_format='PNG', scenes_per_passage=1, characters=3, seed=0, window=60):
+        self.latency = latency                  # Seconds per text request
+        self.image_latency = image_latency      # Seconds per image request
+        self.jitter = jitter                    # +/- fraction of the latency, uniformly distributed
+        self.error_rate = error_rate            # Share of requests answered with a 503
+        self.rpm = rpm                          # Per key and model; above it requests get a 429 (0 = unlimited)
+        self.window = window                    # Seconds `rpm` is counted over (tests shorten it)
+        self.image_size = image_size
+        self.image_format = image_format        # 'PNG' or 'JPEG'
+        self.scenes_per_passage = scenes_per_passage
+        self.characters = characters            # Characters returned by every breakdown
+        self.seed = seed
+
+def noise_image(size, fmt, seed=0):
+    """A photo-like (poorly compressible) test image: gradient plus noise"""
+    from PIL import Image
+    w, h = size
+    rng = random.Random(seed)
+    channels = [Image.effect_noise((w, h), 48).point(lambda v, o=rng.randint(0, 96): min(255, v + o)) for _ in range(3)]
+    img = Image.blend(Image.merge('RGB', channels), Image.linear_gradient('L').resize((w, h)).convert('RGB'), 0.4)
+    out = io.BytesIO()
+    img.save(out, fmt, quality=90)
+    return out.getvalue()
+
+def uniquify(data, n):
+    """Same image, different bytes: a tEXt chunk before IEND (PNG) or a comment after SOI (JPEG)"""
+    import struct
+    import zlib
+    tag = f"mock {n}".encode()
+    if data.startswith(b'\x89PNG'):
+        chunk = b'tEXt' + b'Comment\x00' + tag
+        return data[:-12] + struct.pack('>I', len(tag) + 8) + chunk + struct.pack('>I', zlib.crc32(chunk)) + data[-12:]
+    return data[:2] + b'\xff\xfe' + struct.pack('>H', len(tag) + 2) + tag + data[2:]
+
+class MockGemini:
+    """The server plus its counters (requests, status codes) for reporting"""
+
+    def __init__(self, config=None, host='127.0.0.1', port=0):
+        self.config = config or MockConfig()
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.statuses = defaultdict(int)
+        self.windows = defaultdict(deque)   # (key, model) -> request times in the last config.window seconds
+        self.images = {}                    # (size, format) -> base image bytes
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self.server.daemon_threads = True
+        self.rng = random.Random(self.config.seed)
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/v1beta"
+
+    def start(self):
+        self._image()   # Generate the base image up front so it doesn't land on the first request
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def stats(self):
+        with self.lock:
+            return {'requests': self.requests, 'statuses': dict(self.statuses)}
+
+    # --- Behaviour ---
+    def _admit(self, key, model):
+        """None to answer normally, else (status, retry_after)"""
+        cfg = self.config
+        with self.lock:
+            self.requests += 1
+            if cfg.rpm:
+                window, now = self.windows[(key, model)], time.monotonic()
+                while window and now - window[0] > cfg.window:
+                    window.popleft()
+                if len(window) >= cfg.rpm:
+                    return 429, max(0.1, cfg.window - (now - window[0]))
+                window.append(now)
+            if cfg.error_rate and self.rng.random() < cfg.error_rate:
+                return 503, None
+        return None
+
+    def _sleep(self, seconds):
+        jitter = self.config.jitter
+        time.sleep(max(0.0, seconds * (1 + random.uniform(-jitter, jitter))))
+
+    def _image(self):
+        cfg = self.config
+        key = (tuple(cfg.image_size), cfg.image_format)
+        with self.lock:
+            if key not in self.images:
+                self.images[key] = noise_image(cfg.image_size, cfg.image_format, cfg.seed)
+            n = self.requests
+        return uniquify(self.images[key], n), f"image/{cfg.image_format.lower()}"
+
+    def _text(self, prompt):
+        passages = PASSAGE.findall(prompt)
+        if not passages:
+            return "A cinematic wide shot, dramatic lighting, detailed and moody."
+        cast = [f"[Character {c + 1}]" for c in range(self.config.characters)]
+        storyboard = []
+        for part, text in passages:
+            for n in range(self.config.scenes_per_passage):
+                storyboard.append({
+                    'script': text[:80],
+                    'prompt': f"{cast[(int(part) + n) % len(cast)] if cast else ''} {text[:120]}",
+                    'part': int(part),
+                })
+        return json.dumps({
+            'storyboard': storyboard,
+            'characters': [{'key': k, 'description': f"Description of {k}"} for k in cast],
+        })
+
+    def _handler(self):
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"   # Keep-alive, like the real API
+
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status, body, content_type='application/json', headers=()):
+                with mock.lock:
+                    mock.statuses[status] += 1
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                for k, v in headers:
+                    self.send_header(k, v)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                payload = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+                model = 'image' if 'image' in self.path else 'text'
+                refused = mock._admit(self.headers.get('x-goog-api-key'), model)
+                if refused:
+                    status, retry_after = refused
+                    err = json.dumps({'error': {'code': status, 'message': "mock refused the request"}}).encode()
+                    headers = [('Retry-After', f"{retry_after:.1f}")] if retry_after else []
+                    self._send(status, err, headers=headers)
+                    return
+
+                parts = payload.get('contents', [{}])[0].get('parts', [])
+                prompt = next((p['text'] for p in parts if 'text' in p), '')
+                in_tokens = len(prompt) // 4 + 258 * sum(1 for p in parts if 'inlineData' in p)
+                if model == 'image':
+                    mock._sleep(mock.config.image_latency)
+                    data, mime = mock._image()
+                    part = {'inlineData': {'mimeType': mime, 'data': base64.b64encode(data).decode('ascii')}}
+                    out_tokens = 1290
+                else:
+                    mock._sleep(mock.config.latency)
+                    text = mock._text(prompt)
+                    part = {'text': text}
+                    out_tokens = len(text) // 4
+                usage = {'promptTokenCount': in_tokens, 'candidatesTokenCount': out_tokens,
+                         'totalTokenCount': in_tokens + out_tokens}
+
+                if 'streamGenerateContent' in self.path:
+                    text = part.get('text', '')
+                    events = [{'candidates': [{'content': {'parts': [{'text': text[i:i + 64]}]}}]}
+                              for i in range(0, len(text), 64)]
+                    events.append({'candidates': [], 'usageMetadata': usage})
+                    body = b''.join(b'data: ' + json.dumps(e).encode() + b'\r\n\r\n' for e in events)
+                    self._send(200, body, content_type='text/event-stream')
+                    return
+                body = json.dumps({'candidates': [{'content': {'parts': [part]}}], 'usageMetadata': usage}).encode()
+                self._send(200, body)
+
+        return Handler
+
+def parse_size(text):
+    w, h = text.lower().split('x')
+    return int(w), int(h)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Mock Gemini API for benchmarks and offline runs")
+    parser.add_argument("--host", default='127.0.0.1')
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds per text request")
+    parser.add_argument("--image-latency", type=float, default=0.2, help="Seconds per image request")
+    parser.add_argument("--jitter", type=float, default=0.5, help="+/- fraction of the latency")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of requests answered with 503")
+    parser.add_argument("--rpm", type=int, default=0, help="Requests per minute per key and model before 429s")
+    parser.add_argument("--image-size", type=parse_size, default=(1024, 576), help="WIDTHxHEIGHT")
+    parser.add_argument("--image-format", choices=['PNG', 'JPEG'], default='PNG')
+    parser.add_argument("--scenes-per-passage", type=int, default=1)
+    args = parser.parse_args(argv)
+    config = MockConfig(args.latency, args.image_latency, args.jitter, args.error_rate, args.rpm,
+                        args.image_size, args.image_format, args.scenes_per_passage)
+    mock = MockGemini(config, args.host, args.port)
+    mock._image()
+    print(f"Mock Gemini on {mock.base_url}", flush=True)
+    try:
+        mock.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+"""
+End-to-end benchmark of the headless pipeline against a local mock Gemini server.
+
+    python bench/run_bench.py                              # every scenario at 10, 100 and 1000 scenes
+    python bench/run_bench.py --sizes 10,100 --scenarios batch,export --image-latency 1
+    python bench/run_bench.py --error-rate 0.05 --mock-rpm 120 --keys 2
+
+Scenarios:
+    breakdown  chunked script breakdown of an N-paragraph script (one scene per paragraph)
+    previews   look-dev images for N/10 characters
+    batch      N scene images through the JobQueue (continuity on, as in the app)
+    export     streamed ZIP export of N scene images with a PNG contact sheet
+
+Each (scenario, size) runs in its own subprocess so peak RSS is per run. Reports
+throughput, p50/p95 latency (API requests; thumbnails for export) and peak RSS, prints
+a table and writes it to bench_output.txt at the repo root.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path.insert(0, ROOT)
+
+from mock_gemini import MockConfig, MockGemini, noise_image, parse_size, uniquify
+
+SCENARIOS = ['breakdown', 'previews', 'batch', 'export']
+SIZES = [10, 100, 1000]
+PARAGRAPH = ("The rain had not stopped for three days. [Character {a}] waited under the station awning, "
+             "counting the trains that did not come, while [Character {b}] watched from the café across the square. "
+             "Scene {n}: somewhere a dog barked, and the neon sign above the pharmacy flickered twice and went dark.")
+
+def peak_rss_mb():
+    """Peak resident set size of this process, None where the resource module is missing"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(rss / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)   # Bytes on macOS, KB elsewhere
+
+def make_script(n):
+    return "\n\n".join(PARAGRAPH.format(a=i % 3 + 1, b=(i + 1) % 3 + 1, n=i + 1) for i in range(n))
+
+# ==============================================================================
+# CHILD: one scenario at one size
+# ==============================================================================
+
+def run_child(scenario, size, opts):
+    from scenebuilder_core import (METRICS, POSTPROCESS_WORKERS, ApiKeyPool, BlobStore, GeminiClient, ImageProcessor, JobQueue,
+                                   breakdown_script, build_scene_spec, generate_char_previews,
+                                   plan_scene_jobs, write_zip_export)
+
+    work = tempfile.mkdtemp(prefix="sb_bench_")
+    rpm = {'flash-preview': opts['client_rpm'], 'image-preview': opts['client_rpm']}
+    keys = [f"bench-key-{n}" for n in range(opts['keys'])]
+    client, pool = GeminiClient(base_url=opts['base_url']), ApiKeyPool(keys, rpm)
+    store = BlobStore(os.path.join(work, "blobs"))
+    workers = opts['postprocess_workers']
+    processor = ImageProcessor(POSTPROCESS_WORKERS if workers is None else workers)
+    style = "Moody noir, high contrast, wet streets"
+    characters = [{'key': f"[Character {c + 1}]", 'description': f"Person number {c + 1}"} for c in range(3)]
+    errors = 0
+
+    start = time.perf_counter()
+    if scenario == 'breakdown':
+        data, _ = breakdown_script(client, pool, store, make_script(size), style)
+        items, model = len(data['storyboard']), 'flash-preview'
+    elif scenario == 'previews':
+        cast = [{'key': f"[Character {c + 1}]", 'description': f"Person number {c + 1}"} for c in range(max(1, size // 10))]
+        errors = len(generate_char_previews(client, pool, store, cast, style, [], workers=opts['workers'],
+                                            processor=processor, originals={}))
+        items, model = len(cast), 'image-preview'
+    elif scenario == 'batch':
+        storyboard = [{'script': f"Scene {i + 1}", 'prompt': f"[Character {i % 3 + 1}] in the rain, shot {i + 1}"}
+                      for i in range(size)]
+        queue = JobQueue(client, store, directory=os.path.join(work, "jobs"), processor=processor)
+        spec_for = lambda i: build_scene_spec(storyboard[i], style, characters, [])
+        jobs = plan_scene_jobs(range(size), spec_for, {}, 'alternate')
+        done = queue.wait(queue.submit("bench", "bench", jobs, pool, workers=opts['workers']))
+        errors = sum(1 for j in done if j['state'] != 'done')
+        items, model = size, 'image-preview'
+    elif scenario == 'export':
+        base = noise_image(tuple(opts['image_size']), opts['image_format'])
+        scene_images, originals = {}, {}
+        for i in range(size):
+            working, original = processor.ingest(store, uniquify(base, i))
+            scene_images[str(i)], originals[working] = working, original
+        storyboard = [{'script': f"Scene {i + 1}", 'prompt': f"Shot {i + 1}"} for i in range(size)]
+        start = time.perf_counter()   # Measure the export only, not the seeding
+        with tempfile.TemporaryFile(dir=work) as f:
+            write_zip_export(f, store, scene_images, storyboard, characters, style, contact_sheet='png',
+                             originals=originals)
+            zip_mb = f.tell() / 1e6
+        items, model = size, None
+    else:
+        raise SystemExit(f"Unknown scenario {scenario}")
+    seconds = time.perf_counter() - start
+
+    if model:
+        q = lambda p: METRICS.quantile(p, 'api_request_seconds', model=model, method='generateContent')
+        statuses = {}
+        for status in METRICS.label_values('status', 'api_requests_total'):
+            statuses[status] = METRICS.counter('api_requests_total', model=model, status=status)
+        retries = METRICS.counter('api_retries_total', model=model)
+    else:
+        q = lambda p: METRICS.quantile(p, 'op_seconds', op='thumbnail')
+        statuses, retries = {}, 0
+    p50, p95 = q(0.5), q(0.95)
+    result = {
+        'scenario': scenario, 'size': size, 'items': items, 'errors': errors,
+        'seconds': round(seconds, 3), 'per_s': round(items / seconds, 2) if seconds else None,
+        'p50_ms': round(p50 * 1000, 1) if p50 is not None else None,
+        'p95_ms': round(p95 * 1000, 1) if p95 is not None else None,
+        'rss_mb': peak_rss_mb(), 'retries': retries,
+        'statuses': {str(k): v for k, v in statuses.items() if v},
+    }
+    if scenario == 'export':
+        result['zip_mb'] = round(zip_mb, 1)
+    print(json.dumps(result), flush=True)
+
+# ==============================================================================
+# PARENT: mock server, subprocess per run, report
+# ==============================================================================
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark Scenebuilder against a mock Gemini API")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help=f"Comma separated, from {', '.join(SCENARIOS)}")
+    parser.add_argument("--sizes", default=",".join(map(str, SIZES)), help="Comma separated scene counts")
+    parser.add_argument("--latency", type=float, default=0.05, help="Mock seconds per text request")
+    parser.add_argument("--image-latency", type=float, default=0.2, help="Mock seconds per image request")
+    parser.add_argument("--jitter", type=float, default=0.5, help="+/- fraction of the mock latency")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of mock requests answered with 503")
+    parser.add_argument("--mock-rpm", type=int, default=0, help="Mock per-key rpm before 429s (0 = unlimited)")
+    parser.add_argument("--client-rpm", type=int, default=100000, help="Client-side rpm per key and model")
+    parser.add_argument("--image-size", type=parse_size, default=(1024, 576), help="WIDTHxHEIGHT of mock images")
+    parser.add_argument("--image-format", choices=['PNG', 'JPEG'], default='PNG')
+    parser.add_argument("--keys", type=int, default=4, help="API keys in the pool")
+    parser.add_argument("--workers", type=int, default=16, help="Parallel image requests")
+    parser.add_argument("--postprocess-workers", type=int, default=None,
+                        help="Post-processing processes (default: the app's POSTPROCESS_WORKERS, 0 = inline)")
+    parser.add_argument("--output", default=os.path.join(ROOT, "bench_output.txt"))
+    parser.add_argument("--child", nargs=3, metavar=("SCENARIO", "SIZE", "OPTIONS"), help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+def format_table(rows, header):
+    widths = [max(len(str(h)), *(len(str(r[n])) for r in rows)) for n, h in enumerate(header)]
+    lines = ["  ".join(str(h).ljust(w) for h, w in zip(header, widths))]
+    lines.append("  ".join("-" * w for w in widths))
+    lines += ["  ".join(str(v).rjust(w) for v, w in zip(r, widths)) for r in rows]
+    return "\n".join(lines)
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.child:
+        scenario, size, opts = args.child
+        run_child(scenario, int(size), json.loads(opts))
+        return 0
+
+    config = MockConfig(args.latency, args.image_latency, args.jitter, args.error_rate, args.mock_rpm,
+                        args.image_size, args.image_format)
+    mock = MockGemini(config).start()
+    opts = json.dumps({
+        'base_url': mock.base_url, 'keys': args.keys, 'workers': args.workers, 'client_rpm': args.client_rpm,
+        'postprocess_workers': args.postprocess_workers,
+        'image_size': list(args.image_size), 'image_format': args.image_format,
+    })
+
+    results = []
+    for scenario in args.scenarios.split(","):
+        for size in (int(s) for s in args.sizes.split(",")):
+            print(f"{scenario} x {size} ...", file=sys.stderr, flush=True)
+            proc = subprocess.run([sys.executable, os.path.abspath(__file__), "--child", scenario, str(size), opts],
+                                  capture_output=True, text=True, cwd=ROOT)
+            if proc.returncode:
+                print(proc.stderr, file=sys.stderr)
+                results.append({'scenario': scenario, 'size': size, 'failed': proc.stderr.strip().splitlines()[-1:]})
+                continue
+            results.append(json.loads(proc.stdout.strip().splitlines()[-1]))
+    mock.stop()
+
+    header = ["scenario", "scenes", "items", "errors", "seconds", "items/s", "p50 ms", "p95 ms", "peak RSS MB", "retries", "HTTP statuses"]
+    rows = [[r['scenario'], r['size'], '-', '-', '-', '-', '-', '-', '-', '-', f"FAILED {r['failed']}"] if 'failed' in r else
+            [r['scenario'], r['size'], r['items'], r['errors'], r['seconds'], r['per_s'], r['p50_ms'], r['p95_ms'],
+             r['rss_mb'], r['retries'], " ".join(f"{k}:{v}" for k, v in sorted(r['statuses'].items())) or '-']
+            for r in results]
+    settings = (f"mock latency {args.latency}s text / {args.image_latency}s image (±{args.jitter:.0%}), "
+                f"error rate {args.error_rate:.0%}, mock rpm {args.mock_rpm or 'unlimited'}, "
+                f"{args.image_size[0]}x{args.image_size[1]} {args.image_format}, "
+                f"{args.keys} keys, {args.workers} workers")
+    report = f"{time.strftime('%Y-%m-%d %H:%M:%S')}  {settings}\n\n{format_table(rows, header)}\n"
+    print(report)
+    with open(args.output, 'w', encoding='utf-8') as f:
+        f.write(report)
+        for r in results:
+            f.write(json.dumps(r) + "\n")
+    return 1 if any('failed' in r for r in results) else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
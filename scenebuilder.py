@@ -1,12 +1,20 @@
 import streamlit as st
-import requests
-import json
-import base64
-import io
+import os
 import time
-import zipfile
+import uuid
+from collections import Counter
 import streamlit.components.v1 as components
-from PIL import Image
+from scenebuilder_core import (
+    BATCH_CONCURRENCY, BREAKDOWN_CHUNK_CHARS, CONTINUITY_MODES, EXPORT_DIR, METRICS, METRICS_PORT,
+    PROJECT_BLOB_DIR, REF_MAX_EDGE, ApiKeyPool, BlobStore, CharacterIndex, GeminiClient,
+    GeminiError, ImageProcessor, JobQueue, ProjectStore, QuotaGovernor, ResponseCache,
+    StoryboardStreamParser, bracket_key, breakdown_signature, build_breakdown_payload,
+    build_char_preview_payload, build_image_payload, build_scene_spec, chunk_units,
+    export_signature, extract_image, iter_breakdown_chunks, make_thumbnail, merge_breakdowns,
+    normalize_char_key, normalize_reference, normalize_scene, parse_breakdown, payload_hash,
+    plan_incremental_breakdown, plan_scene_jobs, response_text, serve_metrics, split_script_units,
+    unit_digest, write_zip_export,
+)
 
 # ==============================================================================
 # 1. CONFIG & GLOBAL SETUP
@@ -17,15 +25,23 @@ st.set_page_config(page_title="AI Storyboarder Pro", layout="wide", page_icon="
 # --- API KEY SETUP ---
 # You can hardcode your key here or use st.secrets
 API_KEY = "" 
+API_KEYS = [API_KEY] if API_KEY else []
 
-if not API_KEY and "api_keys" in st.secrets:
-    # Tries to find the key in secrets.toml if not hardcoded
-    # Ensure your secrets.toml looks like: [api_keys] keys = ["YOUR_KEY"]
+if not API_KEYS and "api_keys" in st.secrets:
+    # Tries to find the keys in secrets.toml if not hardcoded
+    # Ensure your secrets.toml looks like: [api_keys] keys = ["KEY_1", "KEY_2", ...]
+    # Every key is used: requests are load-balanced across the whole list.
     try:
-        API_KEY = st.secrets["api_keys"]["keys"][0]
+        API_KEYS = [k for k in st.secrets["api_keys"]["keys"] if k]
     except:
         pass
 
+# --- UI REFRESH ---
+JOB_POLL_SECONDS = 2                                      # How often the UI refreshes batch status
+FILMSTRIP_COLUMNS = 6                                     # Thumbnails per filmstrip row
+FILMSTRIP_PAGE_SIZE = 24                                  # Thumbnails per filmstrip page
+THUMB_CACHE_ENTRIES = 2048                                # Thumbnails kept by st.cache_data
+
 # --- CSS STYLING (Dark/Cinematic) ---
 st.markdown("""
 <style>
@@ -49,89 +65,310 @@ st.markdown("""
 """, unsafe_allow_html=True)
 
 # --- SESSION STATE INITIALIZATION ---
-if 'step' not in st.session_state:
-    st.session_state.update({
+def new_project_state():
+    """The saved part of the session, as it is for a new project"""
+    return {
         'step': 1,
         'style_prompt': '',
-        'style_images': [],       # Global Style Refs: [{'data': b64, 'mime': str}]
+        'style_images': [],       # Global Style Refs: [{'hash': blob hash, 'mime': str}]
         'style_link': '',
         'script_text': '',
         'script_instructions': '',
-        'storyboard': [],         # List of {script: str, prompt: str}
-        'characters': [],         # List of {key: str, description: str, preview: b64}
-        'scene_images': {},       # Generated images {str(index): b64_string}
-        'scene_refs': {},         # Scene-specific refs {str(index): [list of {data, mime}]}
-        'curr_scene': 0
+        'storyboard': [],         # List of {script: str, prompt: str, src: digest of the script unit it came from}
+        'characters': [],         # List of {key: str, description: str, preview: blob hash}
+        'scene_images': {},       # Generated images {str(index): blob hash of the working copy}
+        'originals': {},          # {working copy hash: hash of the image as generated}, for export
+        'scene_refs': {},         # Scene-specific refs {str(index): [list of {hash, mime}]}
+        'curr_scene': 0,
+        'script_units': [],       # Unit digests of the last analysed script (for incremental re-breakdown)
+        'breakdown_sig': '',      # breakdown_signature() of the last breakdown
+        'applied_jobs': [],       # Ids of batch_id's jobs whose images were copied into scene_images
+    }
+
+if 'step' not in st.session_state:
+    st.session_state.update({
+        **new_project_state(),
+        'session_id': uuid.uuid4().hex,  # Owner of background batches
+        'batch_id': None,         # Current background batch (JobQueue)
     })
 
 # ==============================================================================
-# 2. CORE FUNCTIONS (API & LOGIC)
+# 2. CORE FUNCTIONS (Streamlit wrappers around scenebuilder_core)
 # ==============================================================================
 
 def get_api_key():
-    # Sidebar input fallback if no key is set
-    if not API_KEY:
-        return st.sidebar.text_input("Enter Gemini API Key", type="password")
-    return API_KEY
+    """Returns the shared ApiKeyPool for the configured keys (None if no key is set)"""
+    keys = API_KEYS
+    # Sidebar input fallback if no key is set (widget rendered with the sidebar below)
+    if not keys:
+        entered = st.session_state.get('api_key_input', '')
+        keys = [k.strip() for k in entered.split(",") if k.strip()]
+    if not keys:
+        return None
+    return get_key_pool(tuple(keys))
 
-def call_gemini_generic(payload, model="flash-preview"):
+@st.cache_resource
+def get_key_pool(keys):
+    """One pool per key set, shared by every rerun and session so quota tracking is global"""
+    return ApiKeyPool(keys)
+
+@st.cache_resource
+def get_quota_governor():
+    """Concurrency and rate budget of the whole server; sessions take turns within it"""
+    return QuotaGovernor()
+
+@st.cache_resource
+def get_gemini_client():
+    """One client (and connection pool / rate limiter) shared by every rerun and session"""
+    return GeminiClient(governor=get_quota_governor())
+
+@st.cache_resource
+def get_response_cache():
+    return ResponseCache()
+
+def active_cache():
+    """The response cache if the user opted in (sidebar), else None"""
+    return get_response_cache() if st.session_state.get('use_cache') else None
+
+def call_gemini_generic(payload, model="flash-preview", force=False):
     """
     Generic handler for Gemini API calls.
     Models: 
     - 'flash-preview': gemini-2.5-flash-preview-09-2025 (Logic/Text)
     - 'image-preview': gemini-2.5-flash-image-preview (Image Gen)
+    force=True bypasses the response cache (e.g. to get a new variation).
     """
-    key = get_api_key()
-    if not key:
+    keys = get_api_key()
+    if not keys:
         st.error("API Key required.")
         return None
 
-    if model == "image-preview":
-        url = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash-image-preview:generateContent"
-    else:
-        url = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash-preview-09-2025:generateContent"
+    res, err = get_gemini_client().post(payload, model, keys, cache=active_cache(), force=force,
+                                        owner=st.session_state.session_id)
+    if err:
+        st.error(err)
+    return res
 
+def stream_gemini_generic(payload, model="flash-preview", force=False, outcome=None):
+    """
+    Streaming counterpart of call_gemini_generic: yields text fragments, errors go to st.error.
+    A failed stream just stops, so check `outcome` (a dict): 'complete' is only set to True
+    once the whole response has arrived.
+    """
+    outcome = {} if outcome is None else outcome
+    outcome['complete'] = False
+    keys = get_api_key()
+    if not keys:
+        st.error("API Key required.")
+        return
     try:
-        response = requests.post(
-            f"{url}?key={key}",
-            headers={'Content-Type': 'application/json'},
-            json=payload
-        )
-        
-        if response.status_code != 200:
-            st.error(f"API Error {response.status_code}: {response.text}")
-            return None
-            
-        return response.json()
-    except Exception as e:
-        st.error(f"Network Error: {e}")
-        return None
+        yield from get_gemini_client().stream(payload, model, keys, cache=active_cache(), force=force,
+                                              owner=st.session_state.session_id)
+    except GeminiError as e:
+        st.error(str(e))
+    else:
+        outcome['complete'] = True
+
+@st.cache_resource
+def get_blob_store():
+    """Process-wide store; content addressing makes it safe to share between sessions"""
+    return BlobStore(sources=[PROJECT_BLOB_DIR])
 
-def clean_json_text(text):
-    """Extract JSON from potential markdown blocks"""
-    text = text.strip()
-    # FIX: Properly checking for markdown code blocks
-    if text.startswith("```json"):
-        text = text[7:]
-    elif text.startswith("```"):
-        text = text[3:]
-    if text.endswith("```"):
-        text = text[:-3]
-    return text.strip()
+@st.cache_resource
+def get_project_store():
+    return ProjectStore()
+
+def open_project(project_id=None):
+    """
+    Load a saved project into the session (a new, empty one if it doesn't exist); its id goes in the URL.
+    The project's background batch is reattached if the JobQueue still has it, else the newest one
+    still running for the project (e.g. started before a refresh, before batch_id was saved).
+    """
+    state = get_project_store().load(project_id) if project_id else None
+    if state is None:
+        project_id, state = uuid.uuid4().hex[:12], {}
+    job_queue = get_job_queue()
+    batch_id = state.get('batch_id')
+    if not (batch_id and job_queue.batch_jobs(batch_id)):
+        live = [b['id'] for b in job_queue.unfinished_batches(project_id) if b['active']]
+        batch_id = live[-1] if live else None
+        state['applied_jobs'] = []
+    st.session_state.update({**new_project_state(), **state, 'project_id': project_id, 'batch_id': batch_id})
+    # Derived from the previous project's state
+    for key in ('breakdown_chunks', 'char_index', 'film_page'):
+        st.session_state.pop(key, None)
+    # Per-index widget state would otherwise carry the last project's names into this one (and be saved as renames)
+    for key in [k for k in st.session_state if k.startswith(('name_', 'desc_', 'up_'))]:
+        del st.session_state[key]
+    st.query_params['project'] = project_id
+
+def follow_batch(batch_id):
+    """Show `batch_id` in the batch panel; its finished images are copied in as they arrive (None: no batch)"""
+    st.session_state.batch_id = batch_id
+    st.session_state.applied_jobs = []
+
+def autosave():
+    """Write whatever changed since the last save. A project is only created once it has content."""
+    s = st.session_state
+    if 'project_id' in s and (s.style_prompt or s.style_images or s.script_text or s.storyboard):
+        get_project_store().save(s.project_id, s, get_blob_store())
+
+def zip_export_path(project_id, sig, export_args, export_opts):
+    """
+    The project's ZIP export for signature `sig`, written to EXPORT_DIR only if it isn't there
+    yet; the project's older exports are deleted. Plain Python, so it is safe in a deferred download.
+    """
+    name = f"{project_id}-{sig[:16]}.zip"
+    path = os.path.join(EXPORT_DIR, name)
+    if not os.path.exists(path):
+        os.makedirs(EXPORT_DIR, exist_ok=True)
+        tmp = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+        with open(tmp, 'wb') as f:
+            write_zip_export(f, *export_args, **export_opts)
+        os.replace(tmp, path)
+        for old in os.listdir(EXPORT_DIR):
+            if old.startswith(f"{project_id}-") and old.endswith(".zip") and old != name:
+                try:
+                    os.remove(os.path.join(EXPORT_DIR, old))
+                except FileNotFoundError:
+                    pass
+    return path
+
+@st.cache_data(max_entries=512, show_spinner=False)
+def ingest_reference(data, mime, max_edge):
+    """Normalize one upload into the blob store. Cached, so reruns don't decode it again."""
+    norm, norm_mime = normalize_reference(data, mime, max_edge)
+    return {'hash': get_blob_store().put(norm), 'mime': norm_mime}, len(data) - len(norm)
+
+@st.cache_data(max_entries=THUMB_CACHE_ENTRIES, show_spinner=False)
+def scene_thumbnail(blob_hash):
+    """Filmstrip thumbnail, made once per content hash and shared by every session"""
+    return make_thumbnail(get_blob_store().get(blob_hash))
+
+@st.cache_resource
+def get_metrics_server():
+    """Prometheus endpoint for the process-wide METRICS, if SCENEBUILDER_METRICS_PORT is set"""
+    return serve_metrics(METRICS_PORT) if METRICS_PORT else None
+
+def char_index():
+    """The session's CharacterIndex, synced with the current storyboard"""
+    if 'char_index' not in st.session_state:
+        st.session_state.char_index = CharacterIndex()
+    return st.session_state.char_index.sync(st.session_state.storyboard)
+
+@st.cache_resource
+def get_image_processor():
+    """Process pool for post-processing generated images, shared by every session and the JobQueue"""
+    return ImageProcessor()
+
+def store_generated(data):
+    """Post-process a generated image into the blob store; returns the working copy hash"""
+    working, original = get_image_processor().ingest(get_blob_store(), data)
+    if original != working:
+        st.session_state.setdefault('originals', {})[working] = original
+    return working
+
+@st.cache_resource
+def get_job_queue():
+    return JobQueue(get_gemini_client(), get_blob_store(), processor=get_image_processor())
 
 def handle_file_upload(files):
-    """Convert uploaded files to base64 list"""
-    processed = []
+    """Normalize uploaded images into the blob store, returns a list of {'hash', 'mime'} refs"""
+    max_edge = st.session_state.get('ref_max_edge', REF_MAX_EDGE)
+    processed, saved = [], 0
     for f in files:
-        bytes_data = f.getvalue()
-        b64 = base64.b64encode(bytes_data).decode('utf-8')
-        processed.append({'data': b64, 'mime': f.type})
+        ref, ref_saved = ingest_reference(f.getvalue(), f.type, max_edge)
+        processed.append(ref)
+        saved += ref_saved
+    if saved > 0:
+        st.caption(f"🗜️ Reference ingest saved {saved / 1e6:.1f} MB (max edge {max_edge}px)")
     return processed
 
 # ==============================================================================
 # 3. APP SCREENS
 # ==============================================================================
 
+# --- PROJECT: restored from the URL (?project=...), autosaved after every run ---
+url_project = st.query_params.get('project')
+if 'project_id' not in st.session_state or (url_project and url_project != st.session_state.project_id):
+    open_project(url_project)
+elif not url_project:
+    st.query_params['project'] = st.session_state.project_id
+
+with st.sidebar.expander("📁 Project"):
+    project_list = get_project_store().projects()
+    current_project = next((p for p in project_list if p['id'] == st.session_state.project_id), None)
+    if current_project:
+        project_name = st.text_input("Name", value=current_project['name'], key=f"project_name_{current_project['id']}")
+        if project_name.strip() and project_name != current_project['name']:
+            get_project_store().rename(current_project['id'], project_name.strip())
+        st.caption(f"Autosaved {time.strftime('%H:%M:%S', time.localtime(current_project['updated']))}")
+    else:
+        st.caption("Not saved yet: the project is created once it has a style or script.")
+    other_projects = [p for p in project_list if p['id'] != st.session_state.project_id]
+    if other_projects:
+        chosen = st.selectbox("Open project", other_projects, index=None,
+                              format_func=lambda p: f"{p['name']} · {p['scenes']} scenes")
+        if chosen and st.button("Open"):
+            open_project(chosen['id'])
+            st.rerun()
+    if st.button("New project"):
+        open_project()
+        st.rerun()
+
+# --- SIDEBAR: API KEYS ---
+if not API_KEYS:
+    st.sidebar.text_input("Enter Gemini API Key(s)", type="password", key="api_key_input", help="Separate multiple keys with commas")
+
+key_pool = get_api_key()
+if key_pool:
+    with st.sidebar.expander(f"🔑 API Keys ({len(key_pool)})"):
+        st.dataframe(key_pool.snapshot(), hide_index=True, use_container_width=True)
+        # Shared by every user of this server
+        st.caption("Team quota (all sessions)")
+        st.dataframe(get_quota_governor().snapshot(), hide_index=True, use_container_width=True)
+
+# --- SIDEBAR: RESPONSE CACHE ---
+with st.sidebar.expander("💾 Response Cache"):
+    st.toggle("Cache API responses", key="use_cache", help="Identical requests are answered from disk. Use 🎲 New Variation to force a fresh image.")
+    cache_stats = get_response_cache().stats()
+    m1, m2 = st.columns(2)
+    m1.metric("Hits", cache_stats['hits'])
+    m2.metric("Misses", cache_stats['misses'])
+    st.caption(f"{cache_stats['entries']} entries, {cache_stats['bytes'] / 1e6:.1f} MB on disk")
+    if st.button("Clear cache"):
+        get_response_cache().clear()
+        st.rerun()
+
+# --- SIDEBAR: PERFORMANCE ---
+metrics_server = get_metrics_server()
+with st.sidebar.expander("📈 Performance"):
+    api_rows = METRICS.summary()
+    if api_rows:
+        st.dataframe(api_rows, hide_index=True, use_container_width=True)
+    else:
+        st.caption("No API calls yet.")
+    op_rows = METRICS.op_summary()
+    if op_rows:
+        st.dataframe(op_rows, hide_index=True, use_container_width=True)
+    if metrics_server:
+        st.caption(f"Prometheus endpoint: :{METRICS_PORT}/metrics")
+    e1, e2 = st.columns(2)
+    # Built on demand: the event log can be large
+    if e1.button("Export"):
+        st.download_button("Download JSON lines", data=METRICS.jsonl(), file_name="scenebuilder_metrics.jsonl",
+                           mime="application/x-ndjson")
+        st.download_button("Download Prometheus text", data=METRICS.prometheus(), file_name="scenebuilder_metrics.prom",
+                           mime="text/plain")
+    if e2.button("Reset"):
+        METRICS.reset()
+        st.rerun()
+
+# --- SIDEBAR: REFERENCE IMAGES ---
+with st.sidebar.expander("🖼️ Reference Images"):
+    st.number_input("Max edge (px)", min_value=256, max_value=4096, value=REF_MAX_EDGE, step=128, key="ref_max_edge",
+                    help="Uploaded references are downscaled to this size before being sent with every request.")
+
 # --- STEP 1: STYLE DEFINITION ---
 if st.session_state.step == 1:
     st.title("🎬 AI Storyboard Pro")
@@ -159,7 +396,7 @@ if st.session_state.step == 1:
             # Simple preview grid
             cols = st.columns(4)
             for i, img in enumerate(st.session_state.style_images[:4]):
-                cols[i].image(base64.b64decode(img['data']), use_column_width=True)
+                cols[i].image(get_blob_store().get(img['hash']), use_column_width=True)
 
     if st.button("Next: Script Input ➡️", type="primary", use_container_width=True):
         if not st.session_state.style_prompt and not st.session_state.style_images:
@@ -185,61 +422,210 @@ elif st.session_state.step == 2:
         placeholder="e.g., Focus on close-ups, Ignore minor transitions..."
     )
 
+    chunked = st.toggle(
+        "Chunked parallel breakdown",
+        value=len(st.session_state.script_text) > BREAKDOWN_CHUNK_CHARS,
+        help="Split long scripts into overlapping chunks that are analysed concurrently. A chunk that fails is retried on its own."
+    )
+
+    streaming = st.toggle(
+        "Stream scenes as they are produced", value=False, disabled=chunked,
+        help="Single-request mode only: each scene is shown and saved as soon as the model finishes writing it."
+    )
+
+    # Incremental re-breakdown is possible once a storyboard exists for the same style/instructions
+    current_sig = breakdown_signature(st.session_state.style_prompt, st.session_state.script_instructions, st.session_state.style_images)
+    can_increment = bool(st.session_state.storyboard and st.session_state.script_units
+                         and st.session_state.breakdown_sig == current_sig)
+    incremental = False
+    if can_increment:
+        incremental = st.toggle(
+            "Only re-analyze changed passages", value=True,
+            help="Unchanged passages keep their scenes, images and scene refs. Turn off to rebuild the whole storyboard."
+        )
+    elif st.session_state.storyboard:
+        st.caption("Style or instructions changed since the last breakdown: the whole script will be re-analyzed.")
+
+    def run_breakdown_jobs(jobs):
+        """
+        Analyses (context, units) chunks on a worker pool. Returns the parsed result of every
+        chunk in order, or None if any failed. Parsed chunks are remembered, so pressing the
+        button again after a failure only re-runs the chunks that failed.
+        """
+        keys = get_api_key()
+        if not keys:
+            st.error("API Key required.")
+            return None
+        client, cache = get_gemini_client(), active_cache()
+
+        payloads = [
+            build_breakdown_payload(units, st.session_state.style_prompt, st.session_state.script_instructions,
+                                    st.session_state.style_images, get_blob_store(), context)
+            for context, units in jobs
+        ]
+        sigs = [payload_hash("flash-preview", p) for p in payloads]
+        done = {s: d for s, d in st.session_state.get('breakdown_chunks', {}).items() if s in sigs}
+        todo = [n for n, s in enumerate(sigs) if s not in done]
+
+        progress_bar = st.progress(0.0, text=f"Analyzing {len(jobs)} chunks...")
+        failed = []
+        work = {n: (payloads[n], jobs[n][1]) for n in todo}
+        chunks = iter_breakdown_chunks(client, keys, cache, work, owner=st.session_state.session_id)
+        for count, (n, data, err) in enumerate(chunks, start=1):
+            if data is None:
+                failed.append((n, err))
+            else:
+                done[sigs[n]] = data
+            progress_bar.progress(count / len(todo), text=f"Chunk {n+1} finished ({count}/{len(todo)})")
+
+        st.session_state.breakdown_chunks = done
+        if failed:
+            for n, err in sorted(failed):
+                st.error(f"Chunk {n+1}/{len(jobs)}: {err}")
+            st.warning("Press the button again to retry only the failed chunks.")
+            return None
+        return [done[s] for s in sigs]
+
+    def run_incremental_breakdown(units):
+        """
+        Re-analyses only the passages that changed since the last breakdown and splices the
+        new scenes in. Unchanged scenes keep their images and scene refs (re-keyed to their
+        new index); existing characters are kept and new ones appended.
+        """
+        digests = [unit_digest(u) for u in units]
+        plan = plan_incremental_breakdown(st.session_state.script_units, st.session_state.storyboard, digests)
+
+        jobs, segment_jobs = [], []
+        for seg in plan:
+            if seg[0] == 'new':
+                _, j1, j2 = seg
+                seg_chunks = chunk_units(units[j1:j2], before=units[j1 - 1] if j1 else "")
+                segment_jobs.append(range(len(jobs), len(jobs) + len(seg_chunks)))
+                jobs.extend(seg_chunks)
+
+        results = run_breakdown_jobs(jobs) if jobs else []
+        if results is None:
+            return False
+
+        old = st.session_state.storyboard
+        storyboard, images, refs, new_results = [], {}, {}, []
+        seg_iter = iter(segment_jobs)
+        for seg in plan:
+            if seg[0] == 'keep':
+                for n in seg[1]:
+                    if str(n) in st.session_state.scene_images:
+                        images[str(len(storyboard))] = st.session_state.scene_images[str(n)]
+                    if st.session_state.scene_refs.get(str(n)):
+                        refs[str(len(storyboard))] = st.session_state.scene_refs[str(n)]
+                    storyboard.append(old[n])
+            else:
+                seg_results = [results[k] for k in next(seg_iter)]
+                new_results.extend(seg_results)
+                storyboard.extend(merge_breakdowns(seg_results)['storyboard'])
+
+        kept = sum(len(seg[1]) for seg in plan if seg[0] == 'keep')
+        drop_batch()
+        st.session_state.storyboard = storyboard
+        st.session_state.scene_images = images
+        st.session_state.scene_refs = refs
+        st.session_state.characters = merge_breakdowns(new_results, st.session_state.characters)['characters']
+        st.session_state.script_units = digests
+        st.session_state.curr_scene = min(st.session_state.curr_scene, max(0, len(storyboard) - 1))
+        st.session_state.breakdown_notice = f"Re-analyzed {len(jobs)} changed passage chunk(s), kept {kept} scenes."
+        return True
+
+    def drop_batch():
+        """
+        Scene indices are about to change: the current batch's images would land on the wrong
+        scenes, so its queued jobs are cancelled and the panel lets go of it.
+        """
+        if st.session_state.batch_id:
+            get_job_queue().cancel(st.session_state.batch_id)
+        follow_batch(None)
+
+    def apply_full_breakdown(data, units):
+        """A full breakdown replaces the storyboard; old images no longer line up, so they go too"""
+        drop_batch()
+        st.session_state.storyboard = data['storyboard']
+        st.session_state.characters = data['characters']
+        st.session_state.scene_images = {}
+        st.session_state.scene_refs = {}
+        st.session_state.curr_scene = 0
+        st.session_state.script_units = [unit_digest(u) for u in units]
+
+    def run_streaming_breakdown(units):
+        """
+        Single-request breakdown over the streaming endpoint. Scenes are shown as soon as their
+        JSON object is complete; the storyboard is only replaced once the final parse succeeds,
+        so a failed stream leaves the project as it was. Returns True on success.
+        """
+        payload = build_breakdown_payload(
+            units, st.session_state.style_prompt,
+            st.session_state.script_instructions, st.session_state.style_images, get_blob_store()
+        )
+        parser = StoryboardStreamParser()
+        streamed, outcome = [], {}
+        part = 0
+        with st.status("Streaming breakdown...", expanded=True) as status:
+            for fragment in stream_gemini_generic(payload, model="flash-preview", outcome=outcome):
+                for scene in parser.feed(fragment):
+                    if not isinstance(scene, dict) or 'prompt' not in scene:
+                        continue
+                    part = normalize_scene(scene, units, part)
+                    streamed.append(scene)
+                    st.markdown(f"**Scene {len(streamed)}** — {scene['script'] or scene['prompt']}")
+            if not outcome['complete']:
+                status.update(label=f"Stream failed after {len(streamed)} scenes", state="error")
+                return False
+            try:
+                data = parse_breakdown(parser.text, units)
+            except Exception as e:
+                status.update(label=f"Streamed {len(streamed)} scenes", state="error")
+                if parser.text:
+                    st.error(f"Failed to parse AI response: {e}")
+                    st.text(parser.text)
+                return False
+            status.update(label=f"Streamed {len(data['storyboard'])} scenes", state="complete")
+        apply_full_breakdown(data, units)
+        return True
+
     if st.button("Generate Scenes & Characters 🚀", type="primary"):
+        units = split_script_units(st.session_state.script_text)
         if not st.session_state.script_text:
             st.error("Please enter a script.")
+        elif incremental:
+            if run_incremental_breakdown(units):
+                st.session_state.step = 3
+                st.rerun()
+        elif chunked:
+            results = run_breakdown_jobs(chunk_units(units))
+            if results is not None:
+                apply_full_breakdown(merge_breakdowns(results), units)
+                st.session_state.breakdown_sig = current_sig
+                st.session_state.step = 3
+                st.rerun()
+        elif streaming:
+            if run_streaming_breakdown(units):
+                st.session_state.breakdown_sig = current_sig
+                st.session_state.step = 3
+                st.rerun()
         else:
             with st.spinner("Analyzing script, breaking down scenes, and extracting characters..."):
-                # --- LOGIC FROM REACT FILE ---
-                system_instruction = """
-                You are a visual storyboard artist. Read the script and style.
-                1. OUTPUT JSON: { "storyboard": [{ "script": "...", "prompt": "..." }], "characters": [{ "key": "[Name]", "description": "..." }] }
-                2. CRITICAL: Break down the script into VERY small visual moments. Create a separate scene/prompt for:
-                    - Every single sentence.
-                    - Every 15-20 words of narration.
-                    - Or roughly every 5 seconds of reading time.
-                3. DO NOT group multiple concepts into one scene. Split them up!
-                4. Prompts must match the requested style.
-                5. ALWAYS use brackets [ ] for any character reference. e.g., [Adult Griselda], [Police Officer].
-                6. Identify new characters and add them to the characters list.
-                """
-                
-                user_instructions = ""
-                if st.session_state.script_instructions:
-                    user_instructions = f"\nUSER OVERRIDE INSTRUCTIONS: {st.session_state.script_instructions}"
-
-                user_prompt = f"""
-                STYLE PROMPT: {st.session_state.style_prompt}
-                SCRIPT:
-                \"\"\"{st.session_state.script_text}\"\"\"
-                {user_instructions}
-                """
-
-                # Prepare payload with style images if available
-                parts = [{"text": user_prompt}]
-                for img in st.session_state.style_images:
-                    parts.append({"inlineData": {"mimeType": img['mime'], "data": img['data']}})
-
-                payload = {
-                    "contents": [{"parts": parts}],
-                    "systemInstruction": {"parts": [{"text": system_instruction}]},
-                    "generationConfig": {"responseMimeType": "application/json"}
-                }
+                payload = build_breakdown_payload(
+                    units, st.session_state.style_prompt,
+                    st.session_state.script_instructions, st.session_state.style_images, get_blob_store()
+                )
 
                 res = call_gemini_generic(payload, model="flash-preview")
                 
                 if res and 'candidates' in res:
+                    raw_text = ""
                     try:
-                        raw_text = res['candidates'][0]['content']['parts'][0]['text']
-                        data = json.loads(clean_json_text(raw_text))
+                        raw_text = response_text(res)
+                        data = parse_breakdown(raw_text, units)
                         
-                        # Normalize character keys
-                        chars = data.get('characters', [])
-                        for c in chars:
-                            if not c['key'].startswith('['): c['key'] = f"[{c['key']}]"
-                        
-                        st.session_state.storyboard = data.get('storyboard', [])
-                        st.session_state.characters = chars
+                        apply_full_breakdown(data, units)
+                        st.session_state.breakdown_sig = current_sig
                         st.session_state.step = 3
                         st.rerun()
                     except Exception as e:
@@ -250,27 +636,19 @@ elif st.session_state.step == 2:
 # --- STEP 3: CHARACTER CONSISTENCY ---
 elif st.session_state.step == 3:
     st.title("👥 Step 3: Character Lock-in")
-    st.info("Define your characters visuals here. These descriptions and images will be passed to EVERY scene generation to ensure consistency.")
+    if st.session_state.get('breakdown_notice'):
+        st.success(st.session_state.pop('breakdown_notice'))
+    st.info("Define your characters visuals here. A character's description and preview are passed to every scene that mentions its [Key], to ensure consistency.")
 
     # Helper to generate char preview
-    def gen_char_preview(idx):
+    def gen_char_preview(idx, force=False):
         char = st.session_state.characters[idx]
-        prompt = f"**Force 16:9 landscape. Copy style from reference.** Cinematic shot of {char['description']}, Style: {st.session_state.style_prompt}"
-        
-        parts = [{"text": prompt}]
-        # Add global style images
-        for img in st.session_state.style_images:
-            parts.append({"inlineData": {"mimeType": img['mime'], "data": img['data']}})
-            
-        payload = {
-            "contents": [{"parts": parts}],
-            "generationConfig": {"responseModalities": ["IMAGE"]}
-        }
-        
-        res = call_gemini_generic(payload, model="image-preview")
-        if res and 'candidates' in res:
-            b64 = res['candidates'][0]['content']['parts'][0]['inlineData']['data']
-            st.session_state.characters[idx]['preview'] = b64
+        payload = build_char_preview_payload(char, st.session_state.style_prompt,
+                                             st.session_state.style_images, get_blob_store())
+        res = call_gemini_generic(payload, model="image-preview", force=force)
+        data = extract_image(res)
+        if data:
+            st.session_state.characters[idx]['preview'] = store_generated(data)
 
     # UI for Characters
     for i, char in enumerate(st.session_state.characters):
@@ -279,18 +657,35 @@ elif st.session_state.step == 3:
             
             with col_img:
                 if 'preview' in char and char['preview']:
-                    st.image(base64.b64decode(char['preview']), use_column_width=True)
+                    st.image(get_blob_store().get(char['preview']), use_column_width=True)
                 else:
                     st.markdown("<div style='height:100px; background:#1e293b; display:flex; align-items:center; justify-content:center;'>No Preview</div>", unsafe_allow_html=True)
                 
                 if st.button(f"Generate Preview", key=f"gen_char_{i}"):
                     gen_char_preview(i)
                     st.rerun()
+                if char.get('preview') and st.button("🎲 New Variation", key=f"var_char_{i}"):
+                    gen_char_preview(i, force=True)
+                    st.rerun()
 
             with col_txt:
                 c_name = st.text_input("Name (Key)", value=char['key'], key=f"name_{i}")
                 c_desc = st.text_area("Visual Description", value=char['description'], key=f"desc_{i}", height=70)
-                
+
+                # A renamed key is rewritten in every prompt that uses it; renaming onto another
+                # character's key would merge their scenes for good, so that is refused
+                taken = {normalize_char_key(c['key']) for j, c in enumerate(st.session_state.characters) if j != i}
+                if c_name.strip() and normalize_char_key(c_name) in taken:
+                    st.error(f"{bracket_key(c_name)} is already another character's key; pick a different name.")
+                    c_name = char['key']
+                elif c_name.strip() and normalize_char_key(c_name) != normalize_char_key(char['key']):
+                    changed = char_index().rename(st.session_state.storyboard, char['key'], c_name)
+                    if changed:
+                        st.toast(f"Renamed {char['key']} → {bracket_key(c_name)} in {len(changed)} scene prompts")
+                    c_name = bracket_key(c_name)
+                uses = len(char_index().scenes_for(c_name))
+                st.caption(f"Appears in {uses} scene{'s' if uses != 1 else ''}")
+
                 # Update state on change
                 st.session_state.characters[i]['key'] = c_name
                 st.session_state.characters[i]['description'] = c_desc
@@ -309,178 +704,308 @@ elif st.session_state.step == 3:
 elif st.session_state.step == 4:
     
     # --- GENERATION LOGIC (The Core) ---
-    def generate_scene_image(index):
-        """
-        Generates image for a specific scene index using:
-        1. Global Style Images
-        2. Character Context (from Step 3)
-        3. Scene Specific Uploaded References
-        4. Previous Scene Image (for continuity)
-        """
-        scene = st.session_state.storyboard[index]
-        
-        # 1. Build Context String
-        char_context = "\n".join([f"{c['key']}: {c['description']}" for c in st.session_state.characters])
-        
-        # 2. Build Prompt (React logic)
-        final_prompt = f"""
-        **FORCE 16:9 LANDSCAPE.** Copy style from reference images.
-        STYLE: {st.session_state.style_prompt}
-        CONTEXT: {char_context}
-        SCENE: {scene['prompt']}
-        """
-
-        scene_idx_str = str(index)
-        specific_refs = st.session_state.scene_refs.get(scene_idx_str, [])
-
-        if specific_refs:
-            final_prompt += f"\nCRITICAL: Use the provided scene-specific images as key visual references."
-
-        # 3. Construct Payload Parts
-        parts = [{"text": final_prompt}]
-
-        # A. Global Style Refs
-        for img in st.session_state.style_images:
-            parts.append({"inlineData": {"mimeType": img['mime'], "data": img['data']}})
-
-        # B. Scene Specific Refs
-        for img in specific_refs:
-            parts.append({"inlineData": {"mimeType": img['mime'], "data": img['data']}})
+    def scene_spec(index):
+        """Scene spec for `index` from the current session (see build_scene_spec)"""
+        return build_scene_spec(
+            st.session_state.storyboard[index], st.session_state.style_prompt, st.session_state.characters,
+            st.session_state.style_images, st.session_state.scene_refs.get(str(index), []),
+            char_index().keys_for(index)
+        )
 
-        # C. Previous Image (Continuity) - Logic from React file
-        # "Use the last image in the list as the previous scene for visual continuity"
-        prev_idx_str = str(index - 1)
-        if index > 0 and prev_idx_str in st.session_state.scene_images:
-            prev_b64 = st.session_state.scene_images[prev_idx_str]
-            parts.append({"inlineData": {"mimeType": "image/png", "data": prev_b64}})
-            parts[0]['text'] += " (USE THE LAST IMAGE IN THE LIST AS THE PREVIOUS SCENE FOR VISUAL CONTINUITY)"
+    def build_scene_payload(index, prev_index):
+        """Image request for a scene, with the previous scene's image if it exists"""
+        prev_hash = st.session_state.scene_images.get(str(prev_index)) if prev_index is not None else None
+        return build_image_payload(scene_spec(index), get_blob_store(), prev_hash)
 
-        # 4. API Call
-        payload = {
-            "contents": [{"parts": parts}],
-            "generationConfig": {"responseModalities": ["IMAGE"]}
-        }
-        
-        res = call_gemini_generic(payload, model="image-preview")
+    def generate_scene_image(index, force=False):
+        """Generates a single scene, using the previous scene for continuity"""
+        payload = build_scene_payload(index, index - 1 if index > 0 else None)
+        res = call_gemini_generic(payload, model="image-preview", force=force)
         
-        if res and 'candidates' in res:
-            b64 = res['candidates'][0]['content']['parts'][0]['inlineData']['data']
-            st.session_state.scene_images[scene_idx_str] = b64
+        data = extract_image(res)
+        if data:
+            st.session_state.scene_images[str(index)] = store_generated(data)
             return True
         return False
 
-    # --- UI LAYOUT ---
-    
-    # Header
-    st.markdown(f"## Storyboard: Scene {st.session_state.curr_scene + 1} / {len(st.session_state.storyboard)}")
-    
-    current_idx = st.session_state.curr_scene
-    current_scene_data = st.session_state.storyboard[current_idx]
-    current_idx_str = str(current_idx)
+    def submit_scene_batch(indices, mode, workers):
+        """
+        Queues scenes on the background JobQueue, so the batch keeps running while the page
+        is used (or rerun). Specs are built here from session_state; wave order from
+        plan_batch_waves becomes job dependencies for continuity.
+        """
+        keys = get_api_key()
+        if not keys:
+            st.error("API Key required.")
+            return None
 
-    # Main Viewer
-    viewer_col, controls_col = st.columns([2, 1])
+        jobs = plan_scene_jobs(indices, scene_spec, st.session_state.scene_images, mode)
+        if not jobs:
+            return None
+        label = f"{len(jobs)} scenes · {CONTINUITY_MODES[mode]} · {time.strftime('%H:%M')}"
+        return get_job_queue().submit(st.session_state.session_id, label, jobs, keys, active_cache(), workers,
+                                      project=st.session_state.project_id)
 
-    with viewer_col:
-        if current_idx_str in st.session_state.scene_images:
-            st.image(base64.b64decode(st.session_state.scene_images[current_idx_str]), use_column_width=True)
-            
-            # Download button for single scene
-            b64_data = st.session_state.scene_images[current_idx_str]
-            st.download_button("Download Scene", data=base64.b64decode(b64_data), file_name=f"scene_{current_idx+1}.png", mime="image/png")
-        else:
-            st.markdown("""
-            <div style="height: 400px; border: 2px dashed #334155; border-radius: 10px; display: flex; align-items: center; justify-content: center; background: #0f172a;">
-                <p style="color: #64748b;">No image generated yet</p>
-            </div>
-            """, unsafe_allow_html=True)
-
-    with controls_col:
-        st.markdown("### Controls")
-        
-        # Prompt Editor
-        new_prompt = st.text_area("Prompt", value=current_scene_data['prompt'], height=100)
-        if new_prompt != current_scene_data['prompt']:
-            st.session_state.storyboard[current_idx]['prompt'] = new_prompt
-            
-        # Script Viewer
-        st.text_area("Script Snippet", value=current_scene_data['script'], height=80, disabled=True)
-
-        # Scene Specific Ref Upload
-        st.markdown("##### Scene Specific Refs")
-        uploaded_scene_refs = st.file_uploader("Add objects/refs just for this scene", key=f"up_{current_idx}", accept_multiple_files=True)
-        if uploaded_scene_refs:
-            processed_refs = handle_file_upload(uploaded_scene_refs)
-            # Append or Create
-            if current_idx_str not in st.session_state.scene_refs:
-                st.session_state.scene_refs[current_idx_str] = []
-            st.session_state.scene_refs[current_idx_str].extend(processed_refs)
-            st.success("Refs added! Regenerate to use them.")
-
-        # Show existing scene refs count
-        ref_count = len(st.session_state.scene_refs.get(current_idx_str, []))
-        if ref_count > 0:
-            st.caption(f"📎 {ref_count} scene-specific references attached.")
-            if st.button("Clear Scene Refs"):
-                st.session_state.scene_refs[current_idx_str] = []
-                st.rerun()
+    def apply_job_results(jobs):
+        """
+        Copy finished job images into the storyboard, once per job: applied_jobs is saved with the
+        project, so a refresh doesn't copy old results over images made since. Returns the scene indices updated.
+        """
+        applied = set(st.session_state.applied_jobs)
+        updated = []
+        for job in jobs:
+            if job['state'] == 'done' and job['id'] not in applied:
+                applied.add(job['id'])
+                st.session_state.applied_jobs.append(job['id'])
+                if job['index'] < len(st.session_state.storyboard):
+                    st.session_state.scene_images[str(job['index'])] = job['result']
+                    if job.get('original') and job['original'] != job['result']:
+                        st.session_state.setdefault('originals', {})[job['result']] = job['original']
+                    updated.append(job['index'])
+        return updated
 
-        # Actions
-        col_gen, col_enhance = st.columns(2)
-        if col_gen.button("⚡ Generate", type="primary", use_container_width=True):
-            with st.spinner("Dreaming..."):
-                generate_scene_image(current_idx)
-            st.rerun()
-            
-        if col_enhance.button("✨ Enhance Prompt", use_container_width=True):
-            with st.spinner("Improving prompt..."):
-                # Quick LLM call to improve prompt
+    # --- UI LAYOUT ---
+    def go_to_scene(index):
+        st.session_state.curr_scene = index
+        st.session_state.film_page = index // FILMSTRIP_PAGE_SIZE
+
+    def filmstrip(current_idx):
+        """Paginated grid of cached thumbnails; only the visible page is rendered"""
+        total = len(st.session_state.storyboard)
+        pages = max(1, -(-total // FILMSTRIP_PAGE_SIZE))
+        page = min(st.session_state.get('film_page', current_idx // FILMSTRIP_PAGE_SIZE), pages - 1)
+        start, end = page * FILMSTRIP_PAGE_SIZE, min(total, (page + 1) * FILMSTRIP_PAGE_SIZE)
+
+        p_prev, p_label, p_next = st.columns([1, 6, 1])
+        p_prev.button("◀", key="film_prev", disabled=page == 0, use_container_width=True,
+                      on_click=st.session_state.update, kwargs={'film_page': page - 1})
+        p_label.caption(f"Filmstrip · page {page + 1} / {pages} · scenes {start + 1}–{end} of {total}")
+        p_next.button("▶", key="film_next", disabled=page >= pages - 1, use_container_width=True,
+                      on_click=st.session_state.update, kwargs={'film_page': page + 1})
+
+        for row in range(start, end, FILMSTRIP_COLUMNS):
+            cols = st.columns(FILMSTRIP_COLUMNS)
+            for n in range(row, min(end, row + FILMSTRIP_COLUMNS)):
+                with cols[n - row]:
+                    blob_hash = st.session_state.scene_images.get(str(n))
+                    if blob_hash:
+                        st.image(scene_thumbnail(blob_hash), use_column_width=True)
+                    else:
+                        st.caption("No image yet")
+                    st.button(f"Scene {n + 1}", key=f"film_{n}", use_container_width=True,
+                              type="primary" if n == current_idx else "secondary", on_click=go_to_scene, args=(n,))
+
+    # Viewer, controls, navigation and filmstrip rerun on their own: editing a prompt or moving
+    # between scenes doesn't rerun the bulk actions, batch panel or sidebar. Navigation goes
+    # through on_click callbacks, and the viewer is drawn after the controls, so a new image
+    # shows up without another rerun.
+    @st.fragment
+    def scene_workspace():
+        current_idx = st.session_state.curr_scene
+        current_scene_data = st.session_state.storyboard[current_idx]
+        current_idx_str = str(current_idx)
+
+        # Header
+        st.markdown(f"## Storyboard: Scene {current_idx + 1} / {len(st.session_state.storyboard)}")
+
+        # Main Viewer
+        viewer_col, controls_col = st.columns([2, 1])
+
+        with controls_col:
+            st.markdown("### Controls")
+
+            # Prompt Editor
+            new_prompt = st.text_area("Prompt", value=current_scene_data['prompt'], height=100)
+            if new_prompt != current_scene_data['prompt']:
+                st.session_state.storyboard[current_idx]['prompt'] = new_prompt
+
+            # Script Viewer
+            st.text_area("Script Snippet", value=current_scene_data['script'], height=80, disabled=True)
+
+            # Scene Specific Ref Upload
+            st.markdown("##### Scene Specific Refs")
+            uploaded_scene_refs = st.file_uploader("Add objects/refs just for this scene", key=f"up_{current_idx}", accept_multiple_files=True)
+            if uploaded_scene_refs:
+                processed_refs = handle_file_upload(uploaded_scene_refs)
+                # Append or Create
+                if current_idx_str not in st.session_state.scene_refs:
+                    st.session_state.scene_refs[current_idx_str] = []
+                # Same content = same hash, so re-uploads (and reruns) don't attach duplicates
+                existing = {r['hash'] for r in st.session_state.scene_refs[current_idx_str]}
+                st.session_state.scene_refs[current_idx_str].extend(r for r in processed_refs if r['hash'] not in existing)
+                st.success("Refs added! Regenerate to use them.")
+
+            # Show existing scene refs count
+            ref_count = len(st.session_state.scene_refs.get(current_idx_str, []))
+            if ref_count > 0:
+                st.caption(f"📎 {ref_count} scene-specific references attached.")
+                st.button("Clear Scene Refs", on_click=lambda: st.session_state.scene_refs.update({current_idx_str: []}))
+
+            # Actions
+            col_gen, col_var, col_enhance = st.columns(3)
+            if col_gen.button("⚡ Generate", type="primary", use_container_width=True):
+                with st.spinner("Dreaming..."):
+                    generate_scene_image(current_idx)
+
+            if col_var.button("🎲 New Variation", use_container_width=True):
+                with st.spinner("Dreaming..."):
+                    generate_scene_image(current_idx, force=True)
+
+            if col_enhance.button("✨ Enhance Prompt", use_container_width=True):
+                # Quick LLM call to improve prompt, streamed so the text appears as it is written
                 p = f"Improve this image prompt to be more cinematic and detailed, keeping the style '{st.session_state.style_prompt}': {current_scene_data['prompt']}"
-                res = call_gemini_generic({"contents": [{"parts": [{"text": p}]}]})
-                if res:
-                    txt = res['candidates'][0]['content']['parts'][0]['text']
+                outcome = {}
+                txt = st.write_stream(stream_gemini_generic({"contents": [{"parts": [{"text": p}]}]}, outcome=outcome))
+                # A stream cut off mid-way has already shown its error; keep the old prompt
+                if outcome['complete'] and isinstance(txt, str) and txt.strip():
                     st.session_state.storyboard[current_idx]['prompt'] = txt
-                    st.rerun()
+                    st.rerun(scope="fragment")
+
+        with viewer_col:
+            if current_idx_str in st.session_state.scene_images:
+                image_hash = st.session_state.scene_images[current_idx_str]
+                st.image(get_blob_store().get(image_hash), use_column_width=True)
+
+                # Download button for single scene: the image as generated, not the working copy.
+                # Only its header is read per rerun; the full original is loaded on click.
+                original = st.session_state.get('originals', {}).get(image_hash, image_hash)
+                mime, ext = get_blob_store().image_type(original)
+                st.download_button("Download Scene", data=lambda: get_blob_store().get(original, remember=False),
+                                   file_name=f"scene_{current_idx+1}{ext}", mime=mime)
+            else:
+                st.markdown("""
+                <div style="height: 400px; border: 2px dashed #334155; border-radius: 10px; display: flex; align-items: center; justify-content: center; background: #0f172a;">
+                    <p style="color: #64748b;">No image generated yet</p>
+                </div>
+                """, unsafe_allow_html=True)
+
+        # Navigation
+        c1, c2, c3, _ = st.columns([1, 1, 1, 3])
+        c1.button("⬅️ Previous", disabled=current_idx == 0, on_click=go_to_scene, args=(current_idx - 1,))
+        c2.button("Next ➡️", disabled=current_idx >= len(st.session_state.storyboard) - 1,
+                  on_click=go_to_scene, args=(current_idx + 1,))
 
-    st.markdown("---")
-    
-    # Navigation & Bulk Actions
-    nav_col, bulk_col = st.columns([1, 1])
-    
-    with nav_col:
-        c1, c2, c3 = st.columns(3)
-        if c1.button("⬅️ Previous") and current_idx > 0:
-            st.session_state.curr_scene -= 1
-            st.rerun()
-        
-        if c2.button("Next ➡️") and current_idx < len(st.session_state.storyboard) - 1:
-            st.session_state.curr_scene += 1
-            st.rerun()
-            
         if c3.button("Add Scene"):
             st.session_state.storyboard.insert(current_idx + 1, {"script": "", "prompt": "New scene description..."})
-            st.session_state.curr_scene += 1
+            go_to_scene(current_idx + 1)
             st.rerun()
 
+        filmstrip(current_idx)
+        autosave()
+
+    scene_workspace()
+    st.markdown("---")
+
+    # Bulk Actions
+    current_idx = st.session_state.curr_scene
+    bulk_col = st.container()
+
     with bulk_col:
         c4, c5 = st.columns(2)
+        # Quota is per key, so the default worker count scales with the key pool
+        default_workers = min(16, BATCH_CONCURRENCY * max(1, len(key_pool) if key_pool else 1))
+        batch_workers = c4.number_input("Parallel workers", min_value=1, max_value=16, value=default_workers)
+        continuity_mode = c4.selectbox("Continuity", list(CONTINUITY_MODES), format_func=CONTINUITY_MODES.get)
         if c4.button("Generate ALL Remaining"):
-            progress_bar = st.progress(0)
             total = len(st.session_state.storyboard)
-            start = current_idx
-            for i in range(start, total):
-                if str(i) not in st.session_state.scene_images:
-                    with st.spinner(f"Generating Scene {i+1}..."):
-                        generate_scene_image(i)
-                progress_bar.progress((i + 1 - start) / (total - start))
-            st.success("Batch generation complete!")
-            st.rerun()
-            
-        if c5.button("Download All (ZIP)"):
-            zip_buffer = io.BytesIO()
-            with zipfile.ZipFile(zip_buffer, "w") as zf:
-                for idx, b64_data in st.session_state.scene_images.items():
-                    data = base64.b64decode(b64_data)
-                    zf.writestr(f"scene_{int(idx)+1}.png", data)
+            # Scenes a running batch of this project already has queued aren't paid for twice
+            in_flight = get_job_queue().in_flight(st.session_state.project_id)
+            pending = [i for i in range(current_idx, total)
+                       if str(i) not in st.session_state.scene_images and i not in in_flight]
+            new_batch = submit_scene_batch(pending, continuity_mode, int(batch_workers))
+            if new_batch:
+                follow_batch(new_batch)
+                st.rerun()
             
-            st.download_button("Download ZIP", data=zip_buffer.getvalue(), file_name="storyboard.zip", mime="application/zip")
+        sheet_format = c5.selectbox("Contact sheet", [None, 'png', 'pdf'], format_func=lambda f: f.upper() if f else "None")
+        with_manifest = c5.checkbox("Include manifest (prompts & scripts)", value=True)
+        # Read only when the button is clicked (deferred download), from a snapshot of the project as
+        # rendered. The ZIP is kept on disk and only rebuilt when something in it changed; nothing stays
+        # in the session.
+        export_args = (get_blob_store(), dict(st.session_state.scene_images), list(st.session_state.storyboard),
+                       list(st.session_state.characters), st.session_state.style_prompt)
+        export_opts = {'contact_sheet': sheet_format, 'manifest': with_manifest,
+                       'originals': dict(st.session_state.get('originals') or {})}
+        export_sig = export_signature(*export_args[1:], [sheet_format, with_manifest])
+        export_project = st.session_state.project_id
+
+        def build_zip_export():
+            with open(zip_export_path(export_project, export_sig, export_args, export_opts), 'rb') as f:
+                return f.read()
+
+        c5.download_button("Download All (ZIP)", data=build_zip_export, file_name="storyboard.zip",
+                           mime="application/zip", disabled=not st.session_state.scene_images)
+
+    # --- BACKGROUND BATCH STATUS ---
+    # Polls the JobQueue in a fragment, so only this panel reruns while a batch is in flight.
+    JOB_ICONS = {'queued': '⏳', 'running': '🔄', 'done': '✅', 'failed': '❌', 'cancelled': '⛔'}
+    job_queue = get_job_queue()
+    polling = bool(st.session_state.batch_id) and any(
+        j['state'] in ('queued', 'running') for j in job_queue.batch_jobs(st.session_state.batch_id))
+
+    @st.fragment(run_every=JOB_POLL_SECONDS if polling else None)
+    def batch_panel():
+        batch_id = st.session_state.batch_id
+        if batch_id:
+            jobs = job_queue.batch_jobs(batch_id)
+            counts = Counter(j['state'] for j in jobs)
+            updated = apply_job_results(jobs)
+            finished = counts['queued'] + counts['running'] == 0
+
+            st.markdown("### Background Batch")
+            st.progress(counts['done'] / max(1, len(jobs)),
+                        text=" · ".join(f"{JOB_ICONS[s]} {counts[s]} {s}" for s in JOB_ICONS if counts[s]))
+            b1, b2, b3 = st.columns(3)
+            if not finished and b1.button("Cancel batch"):
+                job_queue.cancel(batch_id)
+                st.rerun(scope="fragment")
+            if counts['failed'] and b2.button(f"Retry {counts['failed']} failed"):
+                keys = get_api_key()
+                if keys:
+                    job_queue.retry_failed(batch_id, st.session_state.session_id, keys, active_cache())
+                    st.rerun()
+                else:
+                    st.error("API Key required.")
+            if (counts['cancelled'] or (not finished and not job_queue.is_active(batch_id))) and b3.button("Resume"):
+                keys = get_api_key()
+                if keys:
+                    job_queue.resume(batch_id, st.session_state.session_id, keys, active_cache())
+                    st.rerun()
+                else:
+                    st.error("API Key required.")
+            with st.expander("Per-scene status"):
+                st.dataframe([
+                    {'scene': j['index'] + 1, 'state': f"{JOB_ICONS[j['state']]} {j['state']}", 'error': j['error'][:200]}
+                    for j in jobs
+                ], hide_index=True, use_container_width=True)
+
+            # Full refresh when the scene on screen arrives, or once when the batch ends (stops polling)
+            if st.session_state.curr_scene in updated or (finished and polling):
+                st.rerun()
+
+        orphans = [b for b in job_queue.unfinished_batches(st.session_state.project_id) if b['id'] != batch_id]
+        if orphans:
+            st.markdown("##### Unfinished batches")
+            for b in orphans:
+                col_label, col_resume = st.columns([3, 1])
+                col_label.caption(f"{b['label']} · running" if b['active'] else b['label'])
+                if b['active']:
+                    # Still running in the background: just follow it
+                    if col_resume.button("Show here", key=f"show_{b['id']}"):
+                        follow_batch(b['id'])
+                        st.rerun()
+                elif col_resume.button("Resume here", key=f"resume_{b['id']}"):
+                    keys = get_api_key()
+                    if keys:
+                        job_queue.resume(b['id'], st.session_state.session_id, keys, active_cache())
+                        follow_batch(b['id'])
+                        st.rerun()
+                    else:
+                        st.error("API Key required.")
+        autosave()
+
+    st.markdown("---")
+    batch_panel()
+
+# --- AUTOSAVE (fragments save on their own reruns) ---
+autosave()
@@ -0,0 +1,2409 @@
+"""
+Scenebuilder core: the storyboard pipeline without Streamlit.
+Prompt building, the Gemini client, breakdown, image generation, the job queue and export
+all live here, so they can be imported by the app (scenebuilder.py), by scripts, or run
+headless from the command line:
+
+    python scenebuilder_core.py script.txt --style "noir, 35mm" --refs look.png -o out/
+
+requests and Pillow are imported on first use, which keeps importing this module cheap.
+"""
+import argparse
+import json
+import re
+import base64
+import io
+import os
+import sys
+import time
+import hashlib
+import tempfile
+import random
+import sqlite3
+import threading
+import zipfile
+import difflib
+import functools
+import uuid
+import types
+import multiprocessing
+from collections import Counter, OrderedDict, deque
+from email.utils import parsedate_to_datetime
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+# ==============================================================================
+# 1. CONFIG
+# ==============================================================================
+
+# --- API / NETWORK ---
+# GEMINI_API_BASE can point at a local mock server for testing.
+API_BASE_URL = os.environ.get("GEMINI_API_BASE", "https://generativelanguage.googleapis.com/v1beta").rstrip("/")
+MODELS = {
+    'flash-preview': "gemini-2.5-flash-preview-09-2025",  # Logic/Text
+    'image-preview': "gemini-2.5-flash-image-preview",    # Image Gen
+}
+MODEL_RPM = {'flash-preview': 60, 'image-preview': 10}   # Client-side budget, match to your quota
+CONNECT_TIMEOUT = 10                                      # Seconds
+READ_TIMEOUT = {'flash-preview': 120, 'image-preview': 180}
+HTTP_POOL_SIZE = 16                                       # Keep-alive connections per host
+MAX_RETRIES = 4
+BACKOFF_BASE = 1.0                                        # Seconds, doubled per attempt
+BACKOFF_CAP = 60.0
+RETRY_STATUS = {429, 500, 502, 503, 504}
+KEY_COOLDOWN = {429: 60, 403: 300}                        # Seconds a key is taken out of rotation
+KEY_WAIT_TIMEOUT = 30                                     # Longest a request waits for a benched key before failing
+
+# --- SHARED QUOTA (every user of one server process) ---
+QUOTA_CONCURRENCY = {'flash-preview': 16, 'image-preview': 16}   # Requests in flight at once, all users together
+QUOTA_RPM = {'flash-preview': 0, 'image-preview': 0}             # Team-wide budget per minute (0 = per-key limits only)
+
+# --- METRICS ---
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 80, 160)  # Histogram bounds, seconds
+METRICS_MAX_EVENTS = 20000                                # Recent events kept for the JSON-lines export
+METRICS_PORT = int(os.environ.get("SCENEBUILDER_METRICS_PORT", 0)) or None  # Serve Prometheus text on this port
+
+# --- IMAGE STORE ---
+BLOB_MEMORY_LIMIT = 256 * 1024 * 1024                     # Bytes of images kept in RAM before spilling to disk
+BLOB_DIR = os.environ.get("SCENEBUILDER_BLOB_DIR", os.path.join(tempfile.gettempdir(), "scenebuilder_blobs"))
+BLOB_DISK_LIMIT = 4 * 1024 * 1024 * 1024                  # Least recently used blobs deleted from BLOB_DIR above this
+PART_CACHE_BYTES = 64 * 1024 * 1024                       # Ready-made base64 payload parts kept in RAM
+
+# --- PROJECTS (autosave) ---
+PROJECT_DIR = os.environ.get("SCENEBUILDER_PROJECT_DIR", os.path.join(os.path.expanduser("~"), ".scenebuilder"))
+PROJECT_DB = os.path.join(PROJECT_DIR, "projects.db")
+PROJECT_BLOB_DIR = os.path.join(PROJECT_DIR, "blobs")           # Same layout as BLOB_DIR, never evicted
+
+# --- REFERENCE IMAGES ---
+REF_MAX_EDGE = 1024                                       # Default longest edge of uploaded references (sidebar)
+REF_FORMAT = 'JPEG'                                       # Re-encode format; references with transparency use WEBP
+REF_QUALITY = 85
+
+# --- GENERATED IMAGES (post-processing) ---
+TARGET_ASPECT = 16 / 9                                    # The prompts ask for 16:9 landscape
+ASPECT_TOLERANCE = 0.01                                   # Relative deviation accepted as-is
+CROP_MAX = 0.15                                           # Crop when that loses at most this share of the image, else pad
+WORKING_FORMAT = 'WEBP'                                   # Copy used for display, thumbnails and continuity
+WORKING_QUALITY = 85
+WORKING_WEBP_METHOD = 2                                   # WebP effort 0-6; 2 is ~2x faster than the default for the same size
+WORKING_MAX_EDGE = 1920
+POSTPROCESS_WORKERS = min(4, os.cpu_count() or 1)         # Processes; 0 = post-process in the calling thread
+
+# --- RESPONSE CACHE (opt-in, sidebar) ---
+CACHE_DIR = os.environ.get("SCENEBUILDER_CACHE_DIR", os.path.join(tempfile.gettempdir(), "scenebuilder_cache"))
+CACHE_MAX_BYTES = 1024 * 1024 * 1024                      # Least recently used entries evicted above this
+CACHE_TTL = 7 * 24 * 3600                                 # Seconds before a cached response expires
+
+# --- SCRIPT BREAKDOWN ---
+BREAKDOWN_CHUNK_CHARS = 4000                              # Target chunk size for chunked breakdown
+BREAKDOWN_OVERLAP_CHARS = 400                             # Text before a chunk sent along as context only
+BREAKDOWN_CONCURRENCY = 4                                 # Chunks analysed in parallel
+BREAKDOWN_RETRIES = 2                                     # Re-asks for a chunk whose JSON doesn't parse
+
+# --- LOGIC FROM REACT FILE ---
+BREAKDOWN_SYSTEM_PROMPT = """
+                You are a visual storyboard artist. Read the script and style.
+                1. OUTPUT JSON: { "storyboard": [{ "script": "...", "prompt": "...", "part": 1 }], "characters": [{ "key": "[Name]", "description": "..." }] }
+                2. CRITICAL: Break down the script into VERY small visual moments. Create a separate scene/prompt for:
+                    - Every single sentence.
+                    - Every 15-20 words of narration.
+                    - Or roughly every 5 seconds of reading time.
+                3. DO NOT group multiple concepts into one scene. Split them up!
+                4. Prompts must match the requested style.
+                5. ALWAYS use brackets [ ] for any character reference. e.g., [Adult Griselda], [Police Officer].
+                6. Identify new characters and add them to the characters list.
+                7. The script is split into passages marked <P1>, <P2>, ... Set "part" on every storyboard item to the number of the passage it comes from.
+                """
+
+# --- EXPORT ---
+EXPORT_DIR = os.environ.get("SCENEBUILDER_EXPORT_DIR", os.path.join(tempfile.gettempdir(), "scenebuilder_exports"))
+CONTACT_SHEET_COLUMNS = 5
+CONTACT_SHEET_ROWS = 6                                    # Per page; long storyboards get several pages
+CONTACT_SHEET_THUMB = (384, 216)                          # 16:9 cells
+THUMB_SIZE = (320, 180)                                   # Filmstrip thumbnails
+THUMB_QUALITY = 80
+
+# --- BATCH GENERATION ---
+BATCH_CONCURRENCY = 4   # Default number of scenes generated in parallel
+JOBS_DIR = os.environ.get("SCENEBUILDER_JOBS_DIR", os.path.join(tempfile.gettempdir(), "scenebuilder_jobs"))
+JOB_THREADS = 16                                          # Background worker threads (shared by all batches)
+JOB_RETENTION = 7 * 24 * 3600                             # Finished batches are dropped from the journal after this
+CONTINUITY_MODES = {
+    'alternate': "Alternating keyframes (parallel)",
+    'chain': "Full continuity (sequential)",
+    'off': "No continuity (fully parallel)",
+}
+
+# ==============================================================================
+# 2. CORE FUNCTIONS (API & LOGIC)
+# ==============================================================================
+
+class Metrics:
+    """
+    Process-wide request and processing metrics (thread-safe).
+    Histograms (latency, cumulative buckets as in Prometheus) and counters are keyed by
+    name + labels; every observation is also kept as an event for JSON-lines export.
+    """
+
+    def __init__(self, buckets=METRICS_BUCKETS, max_events=METRICS_MAX_EVENTS):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.histograms = {}  # (name, labels) -> {'counts': [per bucket], 'count', 'sum'}
+        self.counters = {}    # (name, labels) -> value
+        self.events = deque(maxlen=max_events)
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def observe(self, name, seconds, **labels):
+        with self.lock:
+            h = self.histograms.setdefault(self._key(name, labels), {'counts': [0] * len(self.buckets), 'count': 0, 'sum': 0.0})
+            for n, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    h['counts'][n] += 1
+            h['count'] += 1
+            h['sum'] += seconds
+
+    def inc(self, name, value=1, **labels):
+        if not value:
+            return
+        with self.lock:
+            key = self._key(name, labels)
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def event(self, event_type, /, **fields):
+        self.events.append({'ts': round(time.time(), 3), 'type': event_type, **fields})
+
+    def timed(self, op, **labels):
+        """Decorator: time a function into the `op_seconds` histogram"""
+        def wrap(fn):
+            @functools.wraps(fn)
+            def timed_fn(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return fn(*args, **kwargs)
+                finally:
+                    elapsed = time.perf_counter() - start
+                    self.observe('op_seconds', elapsed, op=op, **labels)
+                    self.event('op', op=op, seconds=round(elapsed, 6), **labels)
+            return timed_fn
+        return wrap
+
+    def record_request(self, model, method, status, seconds, bytes_out, bytes_in, attempt):
+        """One HTTP attempt; status is the HTTP code or 'network'"""
+        self.observe('api_request_seconds', seconds, model=model, method=method)
+        self.inc('api_requests_total', model=model, status=status)
+        self.inc('api_bytes_out_total', bytes_out, model=model)
+        self.inc('api_bytes_in_total', bytes_in, model=model)
+        if attempt:
+            self.inc('api_retries_total', model=model)
+        self.event('api', model=model, method=method, status=status, seconds=round(seconds, 4),
+                   bytes_out=bytes_out, bytes_in=bytes_in, attempt=attempt)
+
+    def record_usage(self, model, usage):
+        """Token counts from a response's usageMetadata"""
+        if not usage:
+            return
+        tokens = {
+            'prompt': usage.get('promptTokenCount', 0),
+            'output': usage.get('candidatesTokenCount', 0),
+            'thoughts': usage.get('thoughtsTokenCount', 0),
+        }
+        for kind, n in tokens.items():
+            self.inc('api_tokens_total', n, model=model, kind=kind)
+        self.event('usage', model=model, **tokens)
+
+    def quantile(self, q, name, **labels):
+        """Approximate quantile from a histogram (linear within a bucket), None if empty"""
+        with self.lock:
+            h = self.histograms.get(self._key(name, labels))
+            if not h or not h['count']:
+                return None
+            rank, lower = q * h['count'], 0.0
+            prev = 0
+            for bound, cum in zip(self.buckets, h['counts']):
+                if cum >= rank:
+                    return lower + (bound - lower) * (rank - prev) / max(1, cum - prev)
+                lower, prev = bound, cum
+            return self.buckets[-1]
+
+    def counter(self, name, **labels):
+        with self.lock:
+            return self.counters.get(self._key(name, labels), 0)
+
+    def label_values(self, label, prefix=''):
+        """Every value a label takes across metrics whose name starts with `prefix`"""
+        with self.lock:
+            keys = list(self.histograms) + list(self.counters)
+        return sorted({v for name, labels in keys if name.startswith(prefix) for k, v in labels if k == label})
+
+    def summary(self):
+        """One row per model for the dashboard"""
+        rows = []
+        for model in self.label_values('model', 'api_'):
+            with self.lock:
+                requests = sum(v for (n, l), v in self.counters.items() if n == 'api_requests_total' and ('model', model) in l)
+                errors = sum(v for (n, l), v in self.counters.items()
+                             if n == 'api_requests_total' and ('model', model) in l and dict(l)['status'] != '200')
+            p50, p95 = self.quantile(0.5, 'api_request_seconds', model=model, method='generateContent'), \
+                self.quantile(0.95, 'api_request_seconds', model=model, method='generateContent')
+            rows.append({
+                'model': model, 'requests': requests, 'errors': errors,
+                'retries': self.counter('api_retries_total', model=model),
+                'p50 s': round(p50, 2) if p50 is not None else None,
+                'p95 s': round(p95, 2) if p95 is not None else None,
+                'MB out': round(self.counter('api_bytes_out_total', model=model) / 1e6, 2),
+                'MB in': round(self.counter('api_bytes_in_total', model=model) / 1e6, 2),
+                'tokens in': self.counter('api_tokens_total', model=model, kind='prompt'),
+                'tokens out': self.counter('api_tokens_total', model=model, kind='output'),
+                'cache hits': self.counter('cache_hits_total', model=model),
+            })
+        return rows
+
+    def op_summary(self):
+        """One row per timed operation (payload builds, image decode/encode)"""
+        with self.lock:
+            ops = [(dict(l), h['count'], h['sum']) for (n, l), h in self.histograms.items() if n == 'op_seconds']
+        rows = []
+        for labels, count, total in sorted(ops, key=lambda o: -o[2]):
+            p95 = self.quantile(0.95, 'op_seconds', **labels)
+            rows.append({**labels, 'count': count, 'avg ms': round(total / count * 1000, 2),
+                         'p95 ms': round(p95 * 1000, 2) if p95 is not None else None})
+        return rows
+
+    def jsonl(self):
+        """Recent events as JSON lines"""
+        with self.lock:
+            events = list(self.events)
+        return "".join(json.dumps(e) + "\n" for e in events)
+
+    def prometheus(self, prefix="scenebuilder_"):
+        """Everything in the Prometheus text exposition format"""
+        def fmt(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ""
+            escape = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"')
+            return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in pairs) + "}"
+
+        with self.lock:
+            histograms = sorted(self.histograms.items())
+            counters = sorted(self.counters.items())
+        lines, typed = [], set()
+        for (name, labels), h in histograms:
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {prefix}{name} histogram")
+            for bound, cum in zip(self.buckets, h['counts']):
+                lines.append(f"{prefix}{name}_bucket{fmt(labels, [('le', bound)])} {cum}")
+            lines.append(f"{prefix}{name}_bucket{fmt(labels, [('le', '+Inf')])} {h['count']}")
+            lines.append(f"{prefix}{name}_sum{fmt(labels)} {h['sum']}")
+            lines.append(f"{prefix}{name}_count{fmt(labels)} {h['count']}")
+        for (name, labels), value in counters:
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {prefix}{name} counter")
+            lines.append(f"{prefix}{name}{fmt(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        with self.lock:
+            self.histograms.clear()
+            self.counters.clear()
+            self.events.clear()
+
+METRICS = Metrics()
+
+def serve_metrics(port, metrics=METRICS):
+    """Serve metrics.prometheus() at http://0.0.0.0:port/metrics from a daemon thread"""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = metrics.prometheus().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('0.0.0.0', port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+class TokenBucket:
+    """Thread-safe token bucket: refills `rate` tokens per second up to `capacity`"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, tokens=1):
+        """Block until `tokens` are available, then take them"""
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                wait = (tokens - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def available(self):
+        with self.lock:
+            self._refill()
+            return self.tokens
+
+def parse_retry_after(response):
+    """
+    Seconds the server asked us to wait, or None.
+    Honors the Retry-After header (seconds or HTTP date) and Gemini's RetryInfo.retryDelay.
+    """
+    header = response.headers.get('Retry-After')
+    if header:
+        try:
+            return max(0.0, float(header))
+        except ValueError:
+            try:
+                return max(0.0, parsedate_to_datetime(header).timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+    try:
+        for detail in response.json().get('error', {}).get('details', []):
+            if 'retryDelay' in detail:
+                return float(detail['retryDelay'].rstrip('s'))
+    except (ValueError, AttributeError):
+        pass
+    return None
+
+def backoff_delay(attempt, retry_after=None):
+    """Exponential backoff with full jitter; never shorter than the server's Retry-After"""
+    delay = random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * (2 ** attempt)))
+    if retry_after is not None:
+        delay = max(delay, retry_after + random.uniform(0, BACKOFF_BASE))
+    return delay
+
+def mask_key(key):
+    return f"{key[:4]}…{key[-4:]}" if len(key) > 8 else "…"
+
+class ApiKeyPool:
+    """
+    Load balances requests across several API keys.
+    Each key has its own per-model token bucket (quota is per key). acquire() picks the
+    ready key with the most quota left, least recently used on ties. Keys that return
+    429/403 are taken out of rotation for KEY_COOLDOWN seconds; if no key is usable soon,
+    acquire() gives up instead of blocking. `rpm` overrides MODEL_RPM (e.g. for a benchmark against a mock server).
+    """
+
+    def __init__(self, keys, rpm=None):
+        self.keys = list(keys)
+        self.lock = threading.Lock()
+        self.stats = {k: {'requests': 0, 'errors': 0, 'last_used': 0.0, 'cooldown_until': 0.0, 'last_error': '',
+                          'cooldown_status': None} for k in self.keys}
+        self.last_error = ''
+        # Allow a burst of ~10 seconds worth of requests per key
+        self.limiters = {(k, m): TokenBucket(limit / 60.0, max(1, limit // 6))
+                         for k in self.keys for m, limit in (rpm or MODEL_RPM).items()}
+
+    def __len__(self):
+        return len(self.keys)
+
+    def ready_keys(self, now=None):
+        now = time.monotonic() if now is None else now
+        return [k for k in self.keys if self.stats[k]['cooldown_until'] <= now]
+
+    def acquire(self, model, timeout=KEY_WAIT_TIMEOUT):
+        """
+        Block until a key is out of cooldown and has quota for `model`, then return it.
+        Returns None (see last_error) right away if every key is benched for a 403, which
+        waiting won't fix, or if no key comes out of cooldown within `timeout` seconds.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                ready = self.ready_keys(now)
+                if ready:
+                    key = max(ready, key=lambda k: (self.limiters[(k, model)].available(), -self.stats[k]['last_used']))
+                    self.stats[key]['last_used'] = now
+                    self.stats[key]['requests'] += 1
+                    break
+                if all(s['cooldown_status'] == 403 for s in self.stats.values()):
+                    return None
+                wait = min(s['cooldown_until'] for s in self.stats.values()) - now
+                if now + wait > deadline:
+                    return None
+            time.sleep(max(wait, 0.05))
+        self.limiters[(key, model)].acquire()
+        return key
+
+    def report_error(self, key, status, message="", retry_after=None):
+        """
+        Count an error against a key; rate-limit/permission errors bench it for a while
+        (the server's Retry-After if it sent one, else KEY_COOLDOWN).
+        """
+        with self.lock:
+            s = self.stats[key]
+            s['errors'] += 1
+            s['last_error'] = self.last_error = message[:200]
+            if status in KEY_COOLDOWN:
+                cooldown = retry_after if retry_after is not None else KEY_COOLDOWN[status]
+                s['cooldown_until'] = time.monotonic() + cooldown
+                s['cooldown_status'] = status
+
+    def snapshot(self):
+        """Per-key stats for display (keys masked)"""
+        with self.lock:
+            now = time.monotonic()
+            return [{
+                'key': mask_key(k),
+                'requests': s['requests'],
+                'errors': s['errors'],
+                'cooldown': max(0, int(s['cooldown_until'] - now)),
+                'last_error': s['last_error'],
+            } for k, s in self.stats.items()]
+
+class QuotaGovernor:
+    """
+    Request budget shared by every user of the process: at most `concurrency[model]`
+    requests in flight and `rpm[model]` per minute (0 = no global rate cap; the per-key
+    limits of the ApiKeyPool still apply). Requests waiting for a slot are granted
+    round-robin between owners (sessions, CLI scripts), so one user's "Generate ALL"
+    can't starve everyone else.
+    """
+
+    def __init__(self, concurrency=QUOTA_CONCURRENCY, rpm=QUOTA_RPM):
+        self.concurrency = dict(concurrency)
+        self.buckets = {m: TokenBucket(r / 60.0, max(1, r // 6)) for m, r in rpm.items() if r}
+        self.cond = threading.Condition()
+        self.in_flight = Counter()
+        self.waiting = {m: OrderedDict() for m in MODELS}   # model -> owner -> deque of tickets, in turn order
+        self.granted = Counter()                            # owner -> requests granted
+
+    def _ready_in(self, model):
+        """0 if a request for `model` can start now, else seconds to wait (None: until a release)"""
+        if self.in_flight[model] >= self.concurrency.get(model, 1):
+            return None
+        bucket = self.buckets.get(model)
+        if bucket:
+            available = bucket.available()
+            if available < 1:
+                return (1 - available) / bucket.rate
+        return 0
+
+    def acquire(self, owner, model):
+        """Block until it is `owner`'s turn and the budget allows another `model` request"""
+        ticket = object()
+        with self.cond:
+            turns = self.waiting[model]
+            turns.setdefault(owner, deque()).append(ticket)
+            while True:
+                wait = self._ready_in(model)
+                first_owner, first = next(iter(turns.items()))
+                if wait == 0 and first[0] is ticket:
+                    break
+                self.cond.wait(timeout=min(wait, 1.0) if wait else 1.0)
+            first.popleft()
+            del turns[owner]
+            if first:
+                turns[owner] = first   # Owner goes to the back of the line
+            if model in self.buckets:
+                self.buckets[model].acquire()
+            self.in_flight[model] += 1
+            self.granted[owner] += 1
+            self.cond.notify_all()
+
+    def release(self, model):
+        with self.cond:
+            self.in_flight[model] -= 1
+            self.cond.notify_all()
+
+    def snapshot(self):
+        """Per-model load for display"""
+        with self.cond:
+            return [{
+                'model': m,
+                'in flight': f"{self.in_flight[m]}/{self.concurrency.get(m, 1)}",
+                'waiting': sum(len(q) for q in self.waiting[m].values()),
+                'users waiting': len(self.waiting[m]),
+            } for m in MODELS]
+
+class GeminiClient:
+    """
+    Shared HTTP client for the Gemini API.
+    One keep-alive connection pool for every call, connect/read timeouts and retries with
+    backoff on 429/5xx. Keys and per-key rate limits come from an ApiKeyPool; a key that
+    is rate limited is swapped for another one straight away. With a QuotaGovernor every
+    attempt also waits for its `owner`'s turn in the shared budget, and identical cached
+    requests that are already in flight (e.g. from another session) wait for that response
+    instead of being sent twice.
+    Makes no Streamlit calls, so it is safe to use from worker threads.
+    """
+
+    def __init__(self, base_url=API_BASE_URL, pool_size=HTTP_POOL_SIZE, governor=None):
+        import requests
+        from requests.adapters import HTTPAdapter
+        self.base_url = base_url
+        self.governor = governor
+        self.inflight = {}  # payload_hash -> Event set when that cached request finishes
+        self.inflight_lock = threading.Lock()
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=len(MODELS), pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers['Content-Type'] = 'application/json'
+
+    def url(self, model, method="generateContent"):
+        return f"{self.base_url}/models/{MODELS[model]}:{method}"
+
+    def post(self, payload, model, keys, cache=None, force=False, owner=None):
+        """
+        Raw Gemini API call using a key drawn from the ApiKeyPool `keys`.
+        With a ResponseCache, identical requests are answered from disk unless `force` is set
+        (a forced call still refreshes the cached entry); one that is already in flight is
+        waited for. `owner` is whose turn it is in the QuotaGovernor.
+        Returns (response_json, None) on success or (None, error_message) once retries are exhausted.
+        """
+        if cache is None or force:
+            return self._post(payload, model, keys, cache, owner)
+
+        h = payload_hash(model, payload)
+        while True:
+            res = cache.get(model, payload)
+            if res is not None:
+                METRICS.inc('cache_hits_total', model=model)
+                return res, None
+            with self.inflight_lock:
+                done = self.inflight.get(h)
+                if done is None:
+                    done = self.inflight[h] = threading.Event()
+                    break
+            # Answered from the cache once it lands; if it failed, the next waiter sends it
+            METRICS.inc('cache_coalesced_total', model=model)
+            done.wait()
+
+        METRICS.inc('cache_misses_total', model=model)
+        try:
+            return self._post(payload, model, keys, cache, owner)
+        finally:
+            with self.inflight_lock:
+                del self.inflight[h]
+            done.set()
+
+    def _post(self, payload, model, keys, cache, owner):
+        response, err = self._request(payload, model, keys, owner=owner)
+        if response is None:
+            return None, err
+        try:
+            res = response.json()
+        except ValueError as e:   # A 200 with a truncated/HTML body (e.g. from a proxy)
+            return None, f"Invalid JSON response: {e}"
+        if res is not None:
+            METRICS.record_usage(model, res.get('usageMetadata'))
+        if res is not None and cache is not None and res.get('candidates'):
+            cache.put(model, payload, res)
+        return res, err
+
+    def stream(self, payload, model, keys, cache=None, force=False, owner=None):
+        """
+        Streaming call (streamGenerateContent over SSE): yields text fragments as they arrive.
+        Retries like post() until the response starts; raises GeminiError on failure.
+        A cached response is replayed as a single fragment, and a completed stream is cached.
+        """
+        if cache is not None and not force:
+            res = cache.get(model, payload)
+            if res is not None:
+                METRICS.inc('cache_hits_total', model=model)
+                yield response_text(res)
+                return
+            METRICS.inc('cache_misses_total', model=model)
+
+        import requests
+        start = time.perf_counter()
+        response, err = self._request(payload, model, keys, method="streamGenerateContent", stream=True, owner=owner)
+        if response is None:
+            raise GeminiError(err)
+        pieces, usage = [], None
+        try:
+            for event in iter_sse_json(response.iter_lines(decode_unicode=True)):
+                usage = event.get('usageMetadata') or usage
+                if 'error' in event:
+                    raise GeminiError(f"API Error: {event['error'].get('message', event['error'])}")
+                for cand in event.get('candidates', [])[:1]:
+                    for part in cand.get('content', {}).get('parts', []):
+                        if part.get('text'):
+                            pieces.append(part['text'])
+                            yield part['text']
+        except requests.RequestException as e:
+            raise GeminiError(f"Stream interrupted: {e}")
+        finally:
+            METRICS.observe('api_stream_seconds', time.perf_counter() - start, model=model)
+            METRICS.inc('api_bytes_in_total', response.raw.tell(), model=model)
+            METRICS.record_usage(model, usage)
+            response.close()
+            if self.governor:
+                self.governor.release(model)   # Held by _request for the length of the stream
+
+        if cache is not None and pieces:
+            cache.put(model, payload, {'candidates': [{'content': {'parts': [{'text': "".join(pieces)}]}}]})
+
+    def _request(self, payload, model, keys, method="generateContent", stream=False, owner=None):
+        """
+        Send with retries; returns (200 response, None) or (None, error_message).
+        Each attempt holds a QuotaGovernor slot; for a successful stream the caller releases it.
+        """
+        import requests
+        body = json.dumps(payload).encode('utf-8')  # Serialized once, reused by every retry
+        err = None
+        for attempt in range(MAX_RETRIES + 1):
+            retry_after = None
+            if self.governor:
+                self.governor.acquire(owner, model)
+            streaming = False
+            try:
+                key = keys.acquire(model)
+                if key is None:
+                    return None, f"No API key available (all cooling down after errors). Last error: {keys.last_error}"
+                start = time.perf_counter()
+                try:
+                    # Key goes in a header so it never ends up in exception messages/logs
+                    response = self.session.post(
+                        self.url(model, method),
+                        params={'alt': 'sse'} if stream else None,
+                        headers={'x-goog-api-key': key},
+                        data=body,
+                        timeout=(CONNECT_TIMEOUT, READ_TIMEOUT[model]),
+                        stream=stream
+                    )
+                except (requests.ConnectionError, requests.Timeout) as e:
+                    METRICS.record_request(model, method, 'network', time.perf_counter() - start, len(body), 0, attempt)
+                    err = f"Network Error: {e}"
+                    keys.report_error(key, None, err)
+                except Exception as e:
+                    METRICS.record_request(model, method, 'network', time.perf_counter() - start, len(body), 0, attempt)
+                    keys.report_error(key, None, str(e))
+                    return None, f"Network Error: {e}"
+                else:
+                    # A streamed body is still unread here; stream() counts it as it arrives
+                    received = 0 if stream and response.status_code == 200 else len(response.content)
+                    METRICS.record_request(model, method, response.status_code, time.perf_counter() - start,
+                                           len(body), received, attempt)
+                    if response.status_code == 200:
+                        streaming = stream
+                        return response, None
+                    err = f"API Error {response.status_code}: {response.text}"
+                    retry_after = parse_retry_after(response)
+                    keys.report_error(key, response.status_code, err, retry_after)
+                    if response.status_code in KEY_COOLDOWN and keys.ready_keys():
+                        # Another key still has quota: switch immediately instead of backing off
+                        continue
+                    if response.status_code not in RETRY_STATUS:
+                        return None, err
+            finally:
+                if self.governor and not streaming:
+                    self.governor.release(model)
+
+            if attempt < MAX_RETRIES:
+                time.sleep(backoff_delay(attempt, retry_after))
+        return None, err
+
+class GeminiError(Exception):
+    """A streaming call failed (non-streaming calls return their error message instead)"""
+
+def iter_sse_json(lines):
+    """Decode a server-sent events stream of JSON `data:` payloads"""
+    data = []
+    for line in lines:
+        if line is None:
+            continue
+        if line.startswith('data:'):
+            data.append(line[5:].strip())
+        elif not line.strip() and data:
+            yield json.loads("\n".join(data))
+            data = []
+    if data:
+        yield json.loads("\n".join(data))
+
+class StoryboardStreamParser:
+    """
+    Incremental parser for breakdown JSON that arrives in fragments.
+    feed() returns the storyboard items whose objects were completed by that fragment, so
+    scenes can be shown before the whole response is in. Everything outside the
+    "storyboard" array (e.g. characters) is left for the final parse of `text`.
+    """
+
+    def __init__(self):
+        self.text = ""
+        self.pos = 0
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+        self.string_start = 0
+        self.last_key = None
+        self.in_storyboard = False
+        self.item_start = None
+
+    def feed(self, fragment):
+        self.text += fragment
+        items = []
+        text = self.text
+        for i in range(self.pos, len(text)):
+            ch = text[i]
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif ch == '\\':
+                    self.escaped = True
+                elif ch == '"':
+                    self.in_string = False
+                    if self.depth == 1:
+                        self.last_key = text[self.string_start + 1:i]
+            elif ch == '"':
+                self.in_string = True
+                self.string_start = i
+            elif ch in '{[':
+                if ch == '[' and self.depth == 1 and self.last_key == 'storyboard':
+                    self.in_storyboard = True
+                elif ch == '{' and self.depth == 2 and self.in_storyboard:
+                    self.item_start = i
+                self.depth += 1
+            elif ch in '}]':
+                self.depth -= 1
+                if ch == '}' and self.depth == 2 and self.item_start is not None:
+                    try:
+                        items.append(json.loads(text[self.item_start:i + 1]))
+                    except ValueError:
+                        pass
+                    self.item_start = None
+                elif ch == ']' and self.depth == 1:
+                    self.in_storyboard = False
+        self.pos = len(text)
+        return items
+
+def payload_hash(model, payload):
+    """Canonical hash of a request: model + payload JSON with sorted keys"""
+    canonical = json.dumps(payload, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.sha256(f"{model}\n{canonical}".encode('utf-8')).hexdigest()
+
+class ResponseCache:
+    """
+    Disk cache of API responses, keyed by a canonical hash of model + payload.
+    Entries older than `ttl` are ignored and removed; once the directory grows past
+    `max_bytes` the least recently used entries are evicted. Thread safe.
+    """
+
+    def __init__(self, directory=CACHE_DIR, max_bytes=CACHE_MAX_BYTES, ttl=CACHE_TTL):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+        # Rebuild the LRU order from disk (mtime is bumped on every hit)
+        entries = []
+        for name in os.listdir(directory):
+            if name.endswith('.json'):
+                info = os.stat(os.path.join(directory, name))
+                entries.append((info.st_mtime, name[:-5], info.st_size))
+        self.index = OrderedDict((h, size) for _, h, size in sorted(entries))
+        self.size = sum(self.index.values())
+
+    @staticmethod
+    def key(model, payload):
+        return payload_hash(model, payload)
+
+    def path(self, h):
+        return os.path.join(self.directory, f"{h}.json")
+
+    def get(self, model, payload):
+        """Cached response or None"""
+        h = self.key(model, payload)
+        with self.lock:
+            if h not in self.index:
+                self.misses += 1
+                return None
+            try:
+                with open(self.path(h), 'r', encoding='utf-8') as f:
+                    entry = json.load(f)
+            except (OSError, ValueError):
+                entry = None
+            if entry is None or time.time() - entry['created'] > self.ttl:
+                self._drop(h)
+                self.misses += 1
+                return None
+            self.index.move_to_end(h)
+            os.utime(self.path(h))
+            self.hits += 1
+            return entry['response']
+
+    def put(self, model, payload, response):
+        h = self.key(model, payload)
+        data = json.dumps({'created': time.time(), 'model': model, 'response': response}).encode('utf-8')
+        with self.lock:
+            tmp = f"{self.path(h)}.{threading.get_ident()}.tmp"
+            with open(tmp, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, self.path(h))
+            self.size += len(data) - self.index.pop(h, 0)
+            self.index[h] = len(data)
+            while self.size > self.max_bytes and len(self.index) > 1:
+                self._drop(next(iter(self.index)))
+
+    def _drop(self, h):
+        self.size -= self.index.pop(h, 0)
+        try:
+            os.remove(self.path(h))
+        except FileNotFoundError:
+            pass
+
+    def clear(self):
+        with self.lock:
+            for h in list(self.index):
+                self._drop(h)
+            self.hits = self.misses = 0
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.index), 'bytes': self.size}
+
+@METRICS.timed('decode_response_image')
+def extract_image(res):
+    """Pull the first inline image out of an image-preview response as raw bytes (or None)"""
+    if not res or 'candidates' not in res:
+        return None
+    try:
+        for part in res['candidates'][0]['content']['parts']:
+            if 'inlineData' in part:
+                return base64.b64decode(part['inlineData']['data'])
+    except (KeyError, IndexError, TypeError):
+        pass
+    return None
+
+def plan_batch_waves(pending, generated, mode):
+    """
+    Split pending scene indices into waves that can run concurrently.
+    Each wave is a list of (index, prev_index) tuples; prev_index is the scene whose
+    image is attached for continuity (None = no continuity image).
+    - 'off':       one wave, no continuity.
+    - 'chain':     one scene per wave, each waits for the previous (original behaviour).
+    - 'alternate': keyframes (every other pending scene) first, then the scenes between
+                   them, which use the freshly generated keyframe as their previous scene.
+    """
+    pending = sorted(pending)
+    generated = {int(k) for k in generated}   # scene_images keys are strings
+    if mode == 'off':
+        return [[(i, None) for i in pending]] if pending else []
+    if mode == 'chain':
+        return [[(i, i - 1 if i > 0 else None)] for i in pending]
+
+    keyframes, dependents = [], []
+    run_pos = 0
+    for n, i in enumerate(pending):
+        # Position inside the current run of consecutive pending scenes
+        run_pos = run_pos + 1 if n > 0 and pending[n - 1] == i - 1 else 0
+        if run_pos % 2 == 1:
+            dependents.append((i, i - 1))
+        elif run_pos == 0 and (i - 1) in generated:
+            keyframes.append((i, i - 1))
+        else:
+            keyframes.append((i, None))
+    return [w for w in (keyframes, dependents) if w]
+
+def clean_json_text(text):
+    """Extract JSON from potential markdown blocks"""
+    text = text.strip()
+    # FIX: Properly checking for markdown code blocks
+    if text.startswith("```json"):
+        text = text[7:]
+    elif text.startswith("```"):
+        text = text[3:]
+    if text.endswith("```"):
+        text = text[:-3]
+    return text.strip()
+
+class BlobStore:
+    """
+    Content-addressed image store.
+    Blobs are keyed by the sha256 of their bytes, so identical images are stored once and
+    session_state only holds hashes. Recently used blobs live in an in-memory LRU capped at
+    `memory_limit` bytes; older ones are spilled to `directory` and reloaded on demand.
+    `directory` is a cache too: once it grows past `disk_limit` bytes the least recently
+    used blobs are deleted, except those persist() was called for (e.g. by the JobQueue).
+    Saved projects keep their own copies. `sources` are read-only directories with the
+    same layout (e.g. saved projects) that are looked in when a blob isn't in memory or
+    `directory`; they are never evicted.
+    Base64 is only produced when an API payload is built (see b64 / part).
+    """
+
+    def __init__(self, directory=BLOB_DIR, memory_limit=BLOB_MEMORY_LIMIT, sources=(), disk_limit=BLOB_DISK_LIMIT):
+        self.directory = directory
+        self.sources = list(sources)
+        self.memory_limit = memory_limit
+        self.disk_limit = disk_limit
+        self.cache = OrderedDict()
+        self.size = 0
+        self.parts = OrderedDict()  # (hash, mime) -> ready-made inlineData part
+        self.parts_size = 0
+        self.pinned = set()         # Hashes never evicted from `directory`
+        self.lock = threading.RLock()
+        os.makedirs(directory, exist_ok=True)
+        # Rebuild the LRU order of `directory` from disk (mtime is bumped when a blob is read back)
+        entries = []
+        for sub in os.listdir(directory):
+            sub_dir = os.path.join(directory, sub)
+            if os.path.isdir(sub_dir):
+                for name in os.listdir(sub_dir):
+                    if not name.endswith('.tmp'):
+                        info = os.stat(os.path.join(sub_dir, name))
+                        entries.append((info.st_mtime, name, info.st_size))
+        self.disk = OrderedDict((h, size) for _, h, size in sorted(entries))
+        self.disk_size = sum(self.disk.values())
+
+    def path(self, h, directory=None):
+        return os.path.join(directory or self.directory, h[:2], h)
+
+    def __contains__(self, h):
+        with self.lock:
+            if h in self.cache:
+                return True
+        return any(os.path.exists(self.path(h, d)) for d in [self.directory] + self.sources)
+
+    def put(self, data, cold=False):
+        """
+        Store raw bytes, returns their hash. cold=True writes straight to disk without taking
+        up memory, for blobs that are rarely read (originals kept for export).
+        """
+        h = hashlib.sha256(data).hexdigest()
+        with self.lock:
+            if h in self.cache:
+                self.cache.move_to_end(h)
+                return h
+            if not cold:
+                self._remember(h, data)
+        if cold:
+            self._spill(h, data)
+        return h
+
+    def get(self, h, remember=True):
+        """Raw bytes for a hash (KeyError if unknown). remember=False doesn't load it into memory."""
+        with self.lock:
+            if h in self.cache:
+                self.cache.move_to_end(h)
+                return self.cache[h]
+        for directory in [self.directory] + self.sources:
+            try:
+                with open(self.path(h, directory), 'rb') as f:
+                    data = f.read()
+                break
+            except FileNotFoundError:
+                continue
+        else:
+            raise KeyError(h)
+        if directory == self.directory:
+            self._touch(h)
+        if remember:
+            with self.lock:
+                if h not in self.cache:
+                    self._remember(h, data)
+        return data
+
+    def mime(self, h):
+        return self.image_type(h)[0]
+
+    def image_type(self, h):
+        """(mime, extension) of a blob from its file signature; only reads the header of a blob on disk"""
+        with self.lock:
+            head = self.cache.get(h)
+        if head is None:
+            for directory in [self.directory] + self.sources:
+                try:
+                    with open(self.path(h, directory), 'rb') as f:
+                        head = f.read(16)
+                    break
+                except FileNotFoundError:
+                    continue
+            else:
+                raise KeyError(h)
+        return detect_image_type(head)
+
+    def b64(self, h):
+        return base64.b64encode(self.get(h)).decode('ascii')
+
+    def part(self, h, mime):
+        """
+        Ready-made {"inlineData": ...} payload part, base64 encoded once and reused by every
+        request that attaches this blob. Treat the returned dict as read-only.
+        """
+        key = (h, mime)
+        with self.lock:
+            if key in self.parts:
+                self.parts.move_to_end(key)
+                return self.parts[key]
+        part = {"inlineData": {"mimeType": mime, "data": self.b64(h)}}
+        with self.lock:
+            if key not in self.parts:
+                self.parts[key] = part
+                self.parts_size += len(part['inlineData']['data'])
+                while self.parts_size > PART_CACHE_BYTES and len(self.parts) > 1:
+                    _, old = self.parts.popitem(last=False)
+                    self.parts_size -= len(old['inlineData']['data'])
+        return part
+
+    def _remember(self, h, data):
+        self.cache[h] = data
+        self.size += len(data)
+        # Spill least recently used blobs, always keeping the newest one in memory
+        while self.size > self.memory_limit and len(self.cache) > 1:
+            old, old_data = self.cache.popitem(last=False)
+            self.size -= len(old_data)
+            self._spill(old, old_data)
+
+    def persist(self, h):
+        """
+        Make sure a blob is on disk (it may only be in memory) and stays there for the life
+        of this store, e.g. while a job refers to it
+        """
+        with self.lock:
+            self.pinned.add(h)
+            data = self.cache.get(h)
+        if data is not None:
+            self._spill(h, data)
+
+    def _spill(self, h, data):
+        path = self.path(h)
+        if os.path.exists(path):
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+        with self.lock:
+            self.disk_size += len(data) - self.disk.pop(h, 0)
+            self.disk[h] = len(data)
+            self._evict()
+
+    def _touch(self, h):
+        with self.lock:
+            if h in self.disk:
+                self.disk.move_to_end(h)
+                try:
+                    os.utime(self.path(h))
+                except FileNotFoundError:
+                    pass
+
+    def _evict(self):
+        """Delete least recently used, unpinned blobs from `directory` until it fits disk_limit"""
+        if self.disk_size <= self.disk_limit:
+            return
+        for h in list(self.disk):
+            if self.disk_size <= self.disk_limit or len(self.disk) <= 1:
+                break
+            if h in self.pinned:
+                continue
+            self.disk_size -= self.disk.pop(h)
+            try:
+                os.remove(self.path(h))
+            except FileNotFoundError:
+                pass
+
+@METRICS.timed('normalize_reference')
+def normalize_reference(data, mime, max_edge=REF_MAX_EDGE):
+    """
+    Downscale a reference image so its longest edge is at most `max_edge` and re-encode it
+    compactly (REF_FORMAT, or WEBP when it has transparency).
+    Returns (bytes, mime); the original is kept if it can't be decoded or is already smaller.
+    """
+    from PIL import Image, ImageOps
+    try:
+        img = ImageOps.exif_transpose(Image.open(io.BytesIO(data)))
+        img.thumbnail((max_edge, max_edge), Image.LANCZOS)
+        has_alpha = img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info)
+        fmt = 'WEBP' if has_alpha else REF_FORMAT
+        out = io.BytesIO()
+        img.convert('RGBA' if has_alpha else 'RGB').save(out, fmt, quality=REF_QUALITY)
+    except Exception:
+        return data, mime
+    if out.tell() >= len(data):
+        return data, mime
+    return out.getvalue(), f"image/{fmt.lower()}"
+
+def fit_aspect(img, aspect=TARGET_ASPECT, tolerance=ASPECT_TOLERANCE, crop_max=CROP_MAX):
+    """
+    Bring a PIL image to `aspect`: centre-crop if that loses at most `crop_max` of it,
+    otherwise pad with black bars. Returns (image, 'crop' | 'pad' | None).
+    """
+    from PIL import Image
+    w, h = img.size
+    ratio = w / h
+    if abs(ratio / aspect - 1) <= tolerance:
+        return img, None
+    crop_w, crop_h = (round(h * aspect), h) if ratio > aspect else (w, round(w / aspect))
+    if 1 - (crop_w * crop_h) / (w * h) <= crop_max:
+        left, top = (w - crop_w) // 2, (h - crop_h) // 2
+        return img.crop((left, top, left + crop_w, top + crop_h)), 'crop'
+    pad_w, pad_h = (w, round(w / aspect)) if ratio > aspect else (round(h * aspect), h)
+    canvas = Image.new('RGB', (pad_w, pad_h), (0, 0, 0))
+    canvas.paste(img, ((pad_w - w) // 2, (pad_h - h) // 2))
+    return canvas, 'pad'
+
+def postprocess_image(data, aspect=TARGET_ASPECT, fmt=WORKING_FORMAT, quality=WORKING_QUALITY, max_edge=WORKING_MAX_EDGE):
+    """
+    Working copy of a generated image: fitted to `aspect`, at most `max_edge` on the long
+    side and re-encoded as `fmt`. Runs in worker processes, so it takes and returns plain
+    values: (bytes, adjustment from fit_aspect). The input comes back unchanged if it can't
+    be decoded, or if it already fits and the re-encode isn't smaller.
+    """
+    from PIL import Image
+    try:
+        with Image.open(io.BytesIO(data)) as src:
+            img = src.convert('RGB')
+        img, fix = fit_aspect(img, aspect)
+        img.thumbnail((max_edge, max_edge), Image.LANCZOS)
+        out = io.BytesIO()
+        img.save(out, fmt, quality=quality, method=WORKING_WEBP_METHOD)   # method only applies to WebP
+    except Exception:
+        return data, None
+    if fix is None and out.tell() >= len(data):
+        return data, None
+    return out.getvalue(), fix
+
+class ImageProcessor:
+    """
+    Post-processes generated images (postprocess_image) in a pool of worker processes, so
+    decoding and re-encoding don't hold the GIL the UI and API threads need. Falls back to
+    the calling thread if worker processes can't be started.
+    Spawned workers re-run the parent's __main__, which under `streamlit run` is the app
+    script, so every worker is started up front with a bare __main__ swapped in.
+    """
+
+    def __init__(self, workers=POSTPROCESS_WORKERS):
+        self.pool = None
+        if workers:
+            main = sys.modules['__main__']
+            if getattr(main, 'postprocess_image', None) is not postprocess_image:   # Not the CLI itself
+                sys.modules['__main__'] = types.ModuleType('__main__')
+            try:
+                # spawn, not fork: the processes that own this (Streamlit, the CLI) run threads
+                self.pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+                # Each submit that finds no idle worker starts one, so this starts them all while __main__ is swapped
+                warm = [self.pool.submit(os.getpid) for _ in range(workers)]
+            finally:
+                sys.modules['__main__'] = main
+            try:
+                for f in warm:
+                    f.result()
+            except (BrokenProcessPool, OSError):
+                self.pool = None
+
+    def process(self, data):
+        """(working copy bytes, adjustment) for one image"""
+        if self.pool is not None:
+            try:
+                return self.pool.submit(postprocess_image, data).result()
+            except (BrokenProcessPool, OSError):
+                self.pool = None
+        return postprocess_image(data)
+
+    @METRICS.timed('postprocess')
+    def ingest(self, store, data):
+        """
+        Post-process a generated image into `store`. Returns (working hash, original hash);
+        the original goes straight to disk for export. Both are the same hash when the
+        working copy is the original.
+        """
+        working, fix = self.process(data)
+        METRICS.inc('postprocess_total', source=detect_image_type(data)[0], fix=fix or 'none')
+        if working == data:
+            h = store.put(data)
+            return h, h
+        return store.put(working), store.put(data, cold=True)
+
+SENTENCE_SPLIT = re.compile(r'(?<=[.!?…])\s+|(?<=[.!?…]["\'”’)])\s+')
+
+def split_script_units(text, max_chars=BREAKDOWN_CHUNK_CHARS):
+    """Split a script into paragraphs; paragraphs longer than max_chars are cut at sentence boundaries"""
+    units = []
+    for para in re.split(r'\n\s*\n', text):
+        para = para.strip()
+        if not para:
+            continue
+        if len(para) <= max_chars:
+            units.append(para)
+            continue
+        piece = ""
+        for sentence in SENTENCE_SPLIT.split(para):
+            if piece and len(piece) + len(sentence) + 1 > max_chars:
+                units.append(piece)
+                piece = sentence
+            else:
+                piece = f"{piece} {sentence}" if piece else sentence
+        if piece:
+            units.append(piece)
+    return units
+
+def tail_text(text, max_chars):
+    """The last ~max_chars of text, starting at a sentence (or at least word) boundary"""
+    if len(text) <= max_chars:
+        return text
+    tail = text[-max_chars:]
+    m = SENTENCE_SPLIT.search(tail)
+    if m:
+        return tail[m.end():]
+    return tail.split(' ', 1)[-1]
+
+def unit_digest(unit):
+    """Identity of a script unit; scenes remember the digest of the unit they came from ('src')"""
+    return hashlib.sha1(unit.encode('utf-8')).hexdigest()[:16]
+
+def chunk_units(units, chunk_chars=BREAKDOWN_CHUNK_CHARS, overlap_chars=BREAKDOWN_OVERLAP_CHARS, before=""):
+    """
+    Group script units into chunks of about chunk_chars.
+    Returns [(context, units)]: context is the tail of the preceding text (overlap, starting
+    with `before`), passed to the model for continuity only, so overlapping text is never
+    storyboarded twice.
+    """
+    groups, current, size = [], [], 0
+    for unit in units:
+        if current and size + len(unit) > chunk_chars:
+            groups.append(current)
+            current, size = [], 0
+        current.append(unit)
+        size += len(unit) + 2
+    if current:
+        groups.append(current)
+
+    chunks, prev = [], before
+    for group in groups:
+        chunks.append((tail_text(prev, overlap_chars), group))
+        prev = "\n\n".join(group)
+    return chunks
+
+@METRICS.timed('build_payload', kind='breakdown')
+def build_breakdown_payload(units, style_prompt, instructions, style_images, store, context=""):
+    """
+    Payload for a script breakdown request over a list of script units, numbered <P1>..<Pn>
+    so scenes can be traced back to their passage. `context` is preceding text not to storyboard.
+    """
+    script = "\n\n".join(f"<P{n}>\n{u}" for n, u in enumerate(units, start=1))
+
+    user_instructions = ""
+    if instructions:
+        user_instructions = f"\nUSER OVERRIDE INSTRUCTIONS: {instructions}"
+
+    context_block = ""
+    if context:
+        context_block = f"""
+                PRECEDING CONTEXT (already storyboarded, DO NOT create scenes for it):
+                \"\"\"{context}\"\"\"
+                """
+
+    user_prompt = f"""
+                STYLE PROMPT: {style_prompt}{context_block}
+                SCRIPT:
+                \"\"\"{script}\"\"\"
+                {user_instructions}
+                """
+
+    # Prepare payload with style images if available
+    parts = [{"text": user_prompt}]
+    for img in style_images:
+        parts.append(store.part(img['hash'], img['mime']))
+
+    return {
+        "contents": [{"parts": parts}],
+        "systemInstruction": {"parts": [{"text": BREAKDOWN_SYSTEM_PROMPT}]},
+        "generationConfig": {"responseMimeType": "application/json"}
+    }
+
+def response_text(res):
+    return res['candidates'][0]['content']['parts'][0]['text']
+
+def normalize_char_key(key):
+    """Comparable form of a character key: '[ Adult  Griselda ]' -> 'adult griselda'"""
+    return " ".join(key.strip().strip('[]').split()).lower()
+
+CHAR_KEY_PATTERN = re.compile(r'\[[^\[\]\n]+\]')
+
+def bracket_key(key):
+    """Display form of a character key: 'Griselda' -> '[Griselda]'"""
+    key = key.strip()
+    return key if key.startswith('[') else f"[{key}]"
+
+def prompt_char_keys(prompt):
+    """Normalized character keys a prompt references as [Name], in order of first use"""
+    keys = {}
+    for m in CHAR_KEY_PATTERN.finditer(prompt or ''):
+        keys.setdefault(normalize_char_key(m.group(0)), None)
+    return list(keys)
+
+def rename_char_key(prompt, old, new):
+    """Replace every [old] reference (compared normalized) in a prompt with bracket_key(new)"""
+    old_norm, new_key = normalize_char_key(old), bracket_key(new)
+    return CHAR_KEY_PATTERN.sub(lambda m: new_key if normalize_char_key(m.group(0)) == old_norm else m.group(0), prompt)
+
+class CharacterIndex:
+    """
+    Which scenes reference which character: normalized key -> set of scene indices.
+    sync() only re-scans scenes whose prompt changed since the last call, so it is cheap to
+    call on every rerun. Plain data, so it can live in session_state.
+    """
+
+    def __init__(self):
+        self.prompts = []   # scene index -> prompt as last scanned
+        self.keys = []      # scene index -> [normalized keys]
+        self.scenes = {}    # normalized key -> {scene indices}
+
+    def _unlink(self, n):
+        for key in self.keys[n]:
+            self.scenes[key].discard(n)
+            if not self.scenes[key]:
+                del self.scenes[key]
+
+    def sync(self, storyboard):
+        """Bring the index up to date with the storyboard; returns self"""
+        while len(self.prompts) > len(storyboard):
+            self._unlink(len(self.prompts) - 1)
+            self.prompts.pop()
+            self.keys.pop()
+        for n, scene in enumerate(storyboard):
+            prompt = scene.get('prompt', '')
+            if n < len(self.prompts):
+                if self.prompts[n] == prompt:
+                    continue
+                self._unlink(n)
+                self.prompts[n], self.keys[n] = prompt, prompt_char_keys(prompt)
+            else:
+                self.prompts.append(prompt)
+                self.keys.append(prompt_char_keys(prompt))
+            for key in self.keys[n]:
+                self.scenes.setdefault(key, set()).add(n)
+        return self
+
+    def keys_for(self, index):
+        return self.keys[index] if index < len(self.keys) else []
+
+    def scenes_for(self, key):
+        return sorted(self.scenes.get(normalize_char_key(key), ()))
+
+    def rename(self, storyboard, old, new):
+        """Rewrite [old] as [new] in the prompts that use it; returns the scene indices changed"""
+        changed = self.scenes_for(old)
+        for n in changed:
+            storyboard[n]['prompt'] = rename_char_key(storyboard[n]['prompt'], old, new)
+        self.sync(storyboard)
+        return changed
+
+def normalize_scene(scene, units, part=0):
+    """
+    Fill in defaults and swap the model's "part" number for the digest of its unit ('src').
+    A missing/invalid part inherits `part` (the previous scene's); returns the part used.
+    """
+    scene.setdefault('script', '')
+    try:
+        n = int(scene.pop('part', 0)) - 1
+        if 0 <= n < len(units):
+            part = n
+    except (TypeError, ValueError):
+        pass
+    if units:
+        scene['src'] = unit_digest(units[part])
+    return part
+
+def parse_breakdown(raw_text, units):
+    """
+    Parse breakdown JSON into {'storyboard': [...], 'characters': [...]}, with bracketed
+    character keys. Each scene's "part" number is replaced by the digest of its unit ('src');
+    scenes with a missing/invalid part inherit the previous scene's.
+    Raises ValueError on malformed output.
+    """
+    data = json.loads(clean_json_text(raw_text))
+    storyboard = data.get('storyboard', [])
+    if not isinstance(storyboard, list) or not all(isinstance(s, dict) and 'prompt' in s for s in storyboard):
+        raise ValueError("'storyboard' must be a list of {script, prompt} objects")
+    part = 0
+    for s in storyboard:
+        part = normalize_scene(s, units, part)
+
+    # Normalize character keys
+    chars = [c for c in data.get('characters', []) if isinstance(c, dict) and c.get('key')]
+    for c in chars:
+        if not c['key'].startswith('['): c['key'] = f"[{c['key']}]"
+        c.setdefault('description', '')
+    return {'storyboard': storyboard, 'characters': chars}
+
+def breakdown_chunk(client, keys, cache, payload, units, owner=None):
+    """
+    Worker: analyse one chunk. If its JSON doesn't parse, only this chunk is asked again
+    (bypassing the cache so the bad response isn't replayed). Returns (data, error).
+    """
+    err = None
+    for attempt in range(BREAKDOWN_RETRIES + 1):
+        res, err = client.post(payload, "flash-preview", keys, cache, force=attempt > 0, owner=owner)
+        if res is None:
+            return None, err
+        try:
+            return parse_breakdown(response_text(res), units), None
+        except (KeyError, IndexError, TypeError, ValueError) as e:
+            err = f"Failed to parse AI response: {e}"
+    return None, err
+
+def merge_breakdowns(results, characters=()):
+    """
+    Concatenate chunk storyboards in order; characters are deduplicated by normalized key
+    (existing `characters` come first and win).
+    """
+    storyboard, characters = [], list(characters)
+    seen = {normalize_char_key(c['key']) for c in characters}
+    for data in results:
+        storyboard.extend(data['storyboard'])
+        for c in data['characters']:
+            norm = normalize_char_key(c['key'])
+            if norm not in seen:
+                seen.add(norm)
+                characters.append(c)
+    return {'storyboard': storyboard, 'characters': characters}
+
+def assign_scenes_to_units(digests, storyboard):
+    """
+    Map every scene to the script unit it came from: returns one list of scene indices per unit.
+    Scenes are in script order, so each 'src' is matched at or after the previous match;
+    scenes without a known 'src' (e.g. added by hand) stay with the unit before them.
+    """
+    owner = [[] for _ in digests]
+    if not owner:
+        return owner
+    ptr = 0
+    for n, scene in enumerate(storyboard):
+        src = scene.get('src')
+        if src is not None:
+            for k in range(ptr, len(digests)):
+                if digests[k] == src:
+                    ptr = k
+                    break
+        owner[ptr].append(n)
+    return owner
+
+def plan_incremental_breakdown(old_digests, storyboard, new_digests):
+    """
+    Diff the previous script's unit digests against the new ones.
+    Returns segments in new script order: ('keep', [old scene indices]) for unchanged
+    passages and ('new', j1, j2) for new units j1:j2 that need analysing. Scenes added by
+    hand (no 'src') to a passage that changed or went away are kept, after the scenes that
+    replace it.
+    """
+    owner = assign_scenes_to_units(old_digests, storyboard)
+    matcher = difflib.SequenceMatcher(None, old_digests, new_digests, autojunk=False)
+    plan = []
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            plan.append(('keep', [n for i in range(i1, i2) for n in owner[i]]))
+            continue
+        if j2 > j1:
+            plan.append(('new', j1, j2))
+        manual = [n for i in range(i1, i2) for n in owner[i] if storyboard[n].get('src') is None]
+        if manual:
+            plan.append(('keep', manual))
+    return plan
+
+def breakdown_signature(style_prompt, instructions, style_images):
+    """Inputs besides the script that shape every scene; if they change, re-analyse everything"""
+    return hashlib.sha256(json.dumps([style_prompt, instructions, [i['hash'] for i in style_images]]).encode()).hexdigest()
+
+IMAGE_SIGNATURES = [
+    (b'\x89PNG\r\n\x1a\n', 'image/png', '.png'),
+    (b'\xff\xd8\xff', 'image/jpeg', '.jpg'),
+    (b'GIF8', 'image/gif', '.gif'),
+]
+
+def detect_image_type(data):
+    """(mime, extension) from the file signature; falls back to PNG"""
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp', '.webp'
+    for magic, mime, ext in IMAGE_SIGNATURES:
+        if data.startswith(magic):
+            return mime, ext
+    return 'image/png', '.png'
+
+def export_signature(scene_images, storyboard, characters, style_prompt, options):
+    """Changes whenever anything that ends up in the ZIP changes"""
+    scenes = [[s.get('script', ''), s.get('prompt', '')] for s in storyboard]
+    chars = [[c['key'], c.get('description', '')] for c in characters]
+    blob = json.dumps([sorted(scene_images.items()), scenes, chars, style_prompt, options], sort_keys=True)
+    return hashlib.sha256(blob.encode('utf-8')).hexdigest()
+
+@METRICS.timed('thumbnail')
+def open_thumbnail(data, size):
+    """
+    Decode an image straight to thumbnail size as RGB. JPEGs are decoded at reduced size
+    via draft, so a large image never has to be fully decoded.
+    """
+    from PIL import Image
+    with Image.open(io.BytesIO(data)) as img:
+        img.draft('RGB', size)
+        img = img.convert('RGB')
+    img.thumbnail(size)
+    return img
+
+def make_thumbnail(data, size=THUMB_SIZE, quality=THUMB_QUALITY):
+    """Small JPEG preview of an image"""
+    out = io.BytesIO()
+    open_thumbnail(data, size).save(out, 'JPEG', quality=quality)
+    return out.getvalue()
+
+def iter_contact_sheet_pages(store, entries, columns=CONTACT_SHEET_COLUMNS, rows=CONTACT_SHEET_ROWS, thumb=CONTACT_SHEET_THUMB):
+    """
+    Yield contact sheet pages (PIL images) for [(label, blob hash)], one page at a time.
+    Each image is decoded (JPEGs at reduced size via draft), shrunk and released before the
+    next, so memory stays at one page plus one image.
+    """
+    from PIL import Image, ImageDraw
+    label_h = 24
+    cell_w, cell_h = thumb[0], thumb[1] + label_h
+    per_page = columns * rows
+    for start in range(0, len(entries), per_page):
+        page_entries = entries[start:start + per_page]
+        page_rows = (len(page_entries) + columns - 1) // columns
+        page = Image.new('RGB', (columns * cell_w, page_rows * cell_h), (15, 23, 42))
+        draw = ImageDraw.Draw(page)
+        for n, (label, blob_hash) in enumerate(page_entries):
+            x, y = (n % columns) * cell_w, (n // columns) * cell_h
+            img = open_thumbnail(store.get(blob_hash), thumb)
+            page.paste(img, (x + (thumb[0] - img.width) // 2, y + (thumb[1] - img.height) // 2))
+            draw.text((x + 6, y + thumb[1] + 5), label, fill=(226, 232, 240))
+        yield page
+
+def build_manifest(storyboard, characters, style_prompt, files, char_files=None):
+    """manifest.json content; `files` maps scene index -> file name"""
+    chars = []
+    for c in characters:
+        entry = {'key': c['key'], 'description': c.get('description', '')}
+        if char_files is not None:
+            entry['file'] = char_files.get(c['key'])
+        chars.append(entry)
+    return {
+        'style_prompt': style_prompt,
+        'characters': chars,
+        'scenes': [
+            {'scene': i + 1, 'script': s.get('script', ''), 'prompt': s.get('prompt', ''), 'file': files.get(i)}
+            for i, s in enumerate(storyboard)
+        ],
+    }
+
+def write_zip_export(fileobj, store, scene_images, storyboard, characters, style_prompt,
+                     contact_sheet=None, manifest=True, originals=None):
+    """
+    Stream the storyboard into a ZIP written to `fileobj`, one entry at a time.
+    Images are stored as-is (ZIP_STORED: PNG/JPEG/WEBP are already compressed), the optional
+    manifest is deflated. contact_sheet is None, 'png' (one PNG per page) or 'pdf'.
+    `originals` maps working copy hashes to the originals exported in their place; the
+    contact sheet is made from the (smaller) working copies.
+    """
+    originals = originals or {}
+    entries, files = [], {}
+    with zipfile.ZipFile(fileobj, 'w', allowZip64=True) as zf:
+        for idx in sorted(scene_images, key=int):
+            h = scene_images[idx]
+            data = store.get(originals.get(h, h), remember=False)
+            mime, ext = detect_image_type(data)
+            name = f"scene_{int(idx)+1}{ext}"
+            compress = zipfile.ZIP_STORED if mime in ('image/png', 'image/jpeg', 'image/webp', 'image/gif') else zipfile.ZIP_DEFLATED
+            zf.writestr(name, data, compress_type=compress)
+            del data
+            entries.append((f"Scene {int(idx)+1}", scene_images[idx]))
+            files[int(idx)] = name
+
+        if contact_sheet == 'png':
+            for n, page in enumerate(iter_contact_sheet_pages(store, entries), start=1):
+                buf = io.BytesIO()
+                page.save(buf, 'PNG', optimize=True)
+                zf.writestr(f"contact_sheet_{n:02d}.png", buf.getvalue(), compress_type=zipfile.ZIP_STORED)
+        elif contact_sheet == 'pdf' and entries:
+            # Pillow can append pages to an existing PDF, so only one page is in memory at a time
+            with tempfile.TemporaryDirectory() as tmp:
+                pdf_path = os.path.join(tmp, "contact_sheet.pdf")
+                for n, page in enumerate(iter_contact_sheet_pages(store, entries)):
+                    page.save(pdf_path, 'PDF', resolution=96, append=n > 0)
+                zf.write(pdf_path, "contact_sheet.pdf", compress_type=zipfile.ZIP_DEFLATED)
+
+        if manifest:
+            doc = build_manifest(storyboard, characters, style_prompt, files)
+            zf.writestr("manifest.json", json.dumps(doc, indent=2, ensure_ascii=False), compress_type=zipfile.ZIP_DEFLATED)
+
+CONTINUITY_NOTE = " (USE THE LAST IMAGE IN THE LIST AS THE PREVIOUS SCENE FOR VISUAL CONTINUITY)"
+
+@METRICS.timed('build_payload', kind='image')
+def build_image_payload(spec, store, prev_hash=None):
+    """
+    Image request from a scene spec {'model', 'text', 'refs': [{'hash', 'mime'}]}; a mime of
+    None is read from the blob. prev_hash attaches the previous scene for continuity. Specs
+    are plain data, so they can be queued and persisted and the payload built only when the
+    request is sent.
+    """
+    text = spec['text']
+    parts = [None]
+    for ref in spec['refs']:
+        parts.append(store.part(ref['hash'], ref['mime'] or store.mime(ref['hash'])))
+
+    # C. Previous Image (Continuity) - Logic from React file
+    # "Use the last image in the list as the previous scene for visual continuity"
+    if prev_hash:
+        parts.append(store.part(prev_hash, store.mime(prev_hash)))
+        text += CONTINUITY_NOTE
+    parts[0] = {"text": text}
+
+    return {
+        "contents": [{"parts": parts}],
+        "generationConfig": {"responseModalities": ["IMAGE"]}
+    }
+
+class JobQueue:
+    """
+    Background scene generation that survives Streamlit reruns and restarts.
+    Every state change is appended to a JSON-lines journal that is replayed on startup.
+    Daemon worker threads pick queued jobs whose dependency (the scene they take continuity
+    from) has finished, within each batch's concurrency limit. API keys and the response
+    cache are only held in memory, so a batch loaded from the journal stays paused until
+    it is resumed. Results go through `processor` (an ImageProcessor) if given: 'result' is
+    the working copy, 'original' the image as generated. Workers take turns between the
+    owners of runnable batches, so a big batch doesn't hold every thread while another
+    user's jobs wait.
+    Job states: queued -> running -> done | failed; queued -> cancelled.
+    """
+
+    TERMINAL = ('done', 'failed', 'cancelled')
+
+    def __init__(self, client, store, directory=JOBS_DIR, threads=JOB_THREADS, processor=None):
+        self.client = client
+        self.store = store
+        self.processor = processor
+        self.path = os.path.join(directory, "jobs.jsonl")
+        self.cond = threading.Condition()
+        self.jobs = {}      # job id -> job, in submission order
+        self.batches = {}   # batch id -> {'id', 'owner', 'project', 'label', 'workers', 'created'}
+        self.runtime = {}   # batch id -> {'keys', 'cache'} while a batch has jobs queued or running
+        self.by_batch = {}  # batch id -> [job ids]
+        self.queued = {}    # batch id -> {job id: job} still queued, in queue order (batches with none are left out)
+        self.running = Counter()   # batch id -> jobs running
+        self.served = {}    # owner -> turn number when a worker last took one of their jobs
+        self.turn = 0
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+        for _ in range(threads):
+            threading.Thread(target=self._worker, daemon=True).start()
+
+    # --- Journal ---
+    def _load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        rec = json.loads(line)
+                    except ValueError:
+                        continue  # torn last line after a crash
+                    table = self.batches if rec.pop('type') == 'batch' else self.jobs
+                    table.setdefault(rec['id'], {}).update(rec)
+        except FileNotFoundError:
+            pass
+        # Jobs that were running when the process died go back to the queue
+        for job in self.jobs.values():
+            if job['state'] == 'running':
+                job['state'] = 'queued'
+        # Compact: drop old finished batches, then rewrite one line per record
+        now = time.time()
+        for batch_id, batch in list(self.batches.items()):
+            jobs = [j for j in self.jobs.values() if j['batch'] == batch_id]
+            if now - batch['created'] > JOB_RETENTION and all(j['state'] in self.TERMINAL for j in jobs):
+                del self.batches[batch_id]
+                for j in jobs:
+                    del self.jobs[j['id']]
+        jobs, self.jobs = self.jobs, {}
+        for job in jobs.values():
+            self._add(job)
+        # Keep what the remaining jobs refer to out of the blob store's disk eviction
+        for job in self.jobs.values():
+            for h in [r['hash'] for r in job['spec']['refs']] + [job['prev'], job['result'], job.get('original')]:
+                if h:
+                    self.store.persist(h)
+        tmp = f"{self.path}.tmp"
+        with open(tmp, 'w', encoding='utf-8') as f:
+            for batch in self.batches.values():
+                f.write(json.dumps({'type': 'batch', **batch}) + "\n")
+            for job in self.jobs.values():
+                f.write(json.dumps({'type': 'job', **job}) + "\n")
+        os.replace(tmp, self.path)
+
+    def _append(self, rec):
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(rec) + "\n")
+
+    def _update(self, job, **changes):
+        old = job['state']
+        changes['updated'] = time.time()
+        job.update(changes)
+        self._append({'type': 'job', 'id': job['id'], **changes})
+        if job['state'] != old:
+            self._unindex(job, old)
+            self._index(job)
+            self._settle(job['batch'])
+
+    # --- Indexes (so workers don't scan every job in the journal) ---
+    def _add(self, job):
+        self.jobs[job['id']] = job
+        self.by_batch.setdefault(job['batch'], []).append(job['id'])
+        self._index(job)
+
+    def _index(self, job):
+        """Put a job in the queued/running index for its current state"""
+        batch_id = job['batch']
+        if job['state'] == 'queued':
+            self.queued.setdefault(batch_id, {})[job['id']] = job
+        elif job['state'] == 'running':
+            self.running[batch_id] += 1
+
+    def _unindex(self, job, state):
+        """Take a job out of the queued/running index for its previous `state`"""
+        batch_id = job['batch']
+        if state == 'queued':
+            queued = self.queued[batch_id]
+            del queued[job['id']]
+            if not queued:
+                del self.queued[batch_id]
+        elif state == 'running':
+            self.running[batch_id] -= 1
+            if not self.running[batch_id]:
+                del self.running[batch_id]
+
+    def _settle(self, batch_id):
+        """A batch with nothing queued or running is no longer active: let go of its keys and cache"""
+        if batch_id not in self.queued and batch_id not in self.running:
+            self.runtime.pop(batch_id, None)
+
+    # --- Submitting & controlling batches ---
+    def submit(self, owner, label, jobs, keys, cache=None, workers=BATCH_CONCURRENCY, project=None):
+        """
+        Queue a batch. `jobs` are {'index', 'spec', 'prev_index', 'prev'} in wave order:
+        a job whose prev_index is another job of the batch waits for it and uses its image,
+        otherwise `prev` (a blob hash or None) is the continuity image. `project` is the id
+        of the project the batch belongs to, so only that project offers to resume it.
+        Returns the batch id.
+        """
+        for spec in jobs:
+            for ref in spec['spec']['refs']:
+                self.store.persist(ref['hash'])
+            if spec['prev']:
+                self.store.persist(spec['prev'])
+
+        batch_id = uuid.uuid4().hex[:12]
+        with self.cond:
+            batch = {'id': batch_id, 'owner': owner, 'project': project, 'label': label, 'workers': workers,
+                     'created': time.time()}
+            self.batches[batch_id] = batch
+            self._append({'type': 'batch', **batch})
+            self.runtime[batch_id] = {'keys': keys, 'cache': cache}
+            ids = {}
+            for spec in jobs:
+                job = {
+                    'id': f"{batch_id}-{spec['index']}", 'batch': batch_id, 'index': spec['index'],
+                    'spec': spec['spec'], 'prev': spec['prev'], 'after': ids.get(spec['prev_index']),
+                    'state': 'queued', 'result': None, 'original': None, 'error': '', 'updated': time.time(),
+                }
+                ids[spec['index']] = job['id']
+                self._add(job)
+                self._append({'type': 'job', **job})
+            self.cond.notify_all()
+        return batch_id
+
+    def _batch(self, batch_id):
+        return [self.jobs[i] for i in self.by_batch.get(batch_id, ())]
+
+    def batch_jobs(self, batch_id):
+        """Snapshot of a batch's jobs, in scene order"""
+        with self.cond:
+            return sorted((dict(j) for j in self._batch(batch_id)), key=lambda j: j['index'])
+
+    def is_active(self, batch_id):
+        with self.cond:
+            return batch_id in self.runtime
+
+    def cancel(self, batch_id):
+        """Cancel queued jobs (running ones finish; their result is kept)"""
+        with self.cond:
+            for job in list(self.queued.get(batch_id, {}).values()):
+                self._update(job, state='cancelled')
+
+    def retry_failed(self, batch_id, owner, keys, cache=None):
+        """Queue a batch's failed jobs again, under this session's keys"""
+        self._reactivate(batch_id, owner, keys, cache, ('failed',))
+
+    def resume(self, batch_id, owner, keys, cache=None):
+        """Reactivate a batch (e.g. after a restart or cancel) under this session's keys; failed jobs are retried too"""
+        self._reactivate(batch_id, owner, keys, cache, ('cancelled', 'failed'))
+
+    def _reactivate(self, batch_id, owner, keys, cache, states):
+        with self.cond:
+            batch = self.batches[batch_id]
+            batch['owner'] = owner
+            self._append({'type': 'batch', 'id': batch_id, 'owner': owner})
+            self.runtime[batch_id] = {'keys': keys, 'cache': cache}
+            for job in self._batch(batch_id):
+                if job['state'] in states:
+                    self._update(job, state='queued', error='')
+            self._settle(batch_id)
+            self.cond.notify_all()
+
+    def in_flight(self, project):
+        """Scene indices queued or running in the project's active batches"""
+        with self.cond:
+            return {job['index'] for batch_id in self.runtime if self.batches[batch_id].get('project') == project
+                    for job in self._batch(batch_id) if job['state'] in ('queued', 'running')}
+
+    def wait(self, batch_id):
+        """Block until every job of the batch is done, failed or cancelled; returns batch_jobs"""
+        with self.cond:
+            while batch_id in self.queued or batch_id in self.running:
+                self.cond.wait(timeout=1.0)
+        return self.batch_jobs(batch_id)
+
+    def unfinished_batches(self, project):
+        """
+        The project's batches with work left, oldest first. 'active' is True for ones still
+        running, e.g. after the session that started them was closed or refreshed; False for
+        batches interrupted by a restart or that ended with failed or cancelled jobs.
+        """
+        with self.cond:
+            return [{**b, 'active': b['id'] in self.runtime} for b in self.batches.values()
+                    if b.get('project') == project and any(j['state'] != 'done' for j in self._batch(b['id']))]
+
+    # --- Workers ---
+    def _next_job(self):
+        """
+        First runnable job of the owner who was served longest ago (round-robin). Only looks
+        at the queued jobs of active batches that have a worker slot free.
+        """
+        first = {}  # owner -> their first runnable job
+        for batch_id, queued in self.queued.items():
+            batch = self.batches[batch_id]
+            if batch_id not in self.runtime or batch['owner'] in first or self.running[batch_id] >= batch['workers']:
+                continue
+            for job in queued.values():
+                dep = self.jobs.get(job['after'])
+                if not dep or dep['state'] in self.TERMINAL:
+                    first[batch['owner']] = job
+                    break
+        if not first:
+            return None
+        owner = min(first, key=lambda o: self.served.get(o, -1))
+        self.turn += 1
+        self.served[owner] = self.turn
+        return first[owner]
+
+    def _worker(self):
+        while True:
+            with self.cond:
+                job = self._next_job()
+                while job is None:
+                    self.cond.wait(timeout=30.0)   # Every change that can make a job runnable notifies
+                    job = self._next_job()
+                self._update(job, state='running')
+                runtime, owner = self.runtime[job['batch']], self.batches[job['batch']]['owner']
+                dep = self.jobs.get(job['after'])
+                prev = dep['result'] if dep and dep['state'] == 'done' else job['prev']
+
+            result, original, err = None, None, None
+            try:
+                payload = build_image_payload(job['spec'], self.store, prev)
+                res, err = self.client.post(payload, job['spec']['model'], runtime['keys'], runtime['cache'],
+                                            owner=owner)
+                data = extract_image(res)
+                if data:
+                    if self.processor:
+                        result, original = self.processor.ingest(self.store, data)
+                    else:
+                        result = original = self.store.put(data)
+                    self.store.persist(result)
+                    self.store.persist(original)
+            except Exception as e:
+                err = f"{type(e).__name__}: {e}"
+
+            with self.cond:
+                if result:
+                    self._update(job, state='done', result=result, original=original, error='')
+                else:
+                    self._update(job, state='failed', error=err or "No image returned")
+                self.cond.notify_all()
+
+PROJECT_META_KEYS = ('step', 'style_prompt', 'style_images', 'style_link', 'script_text', 'script_instructions',
+                     'curr_scene', 'script_units', 'breakdown_sig', 'batch_id', 'applied_jobs')
+
+def project_rows(state):
+    """
+    Flatten a project into rows {(kind, key): value}: one per meta field, scene, character,
+    scene image, scene ref list and original of an image in use. Values are the live
+    objects, nothing is serialized here.
+    """
+    rows = {('meta', k): state[k] for k in PROJECT_META_KEYS if k in state}
+    rows.update((('scene', str(n)), s) for n, s in enumerate(state.get('storyboard', [])))
+    rows.update((('character', str(n)), c) for n, c in enumerate(state.get('characters', [])))
+    rows.update((('image', k), h) for k, h in state.get('scene_images', {}).items())
+    rows.update((('refs', k), r) for k, r in state.get('scene_refs', {}).items() if r)
+    used = set(state.get('scene_images', {}).values()) | {c['preview'] for c in state.get('characters', []) if c.get('preview')}
+    rows.update((('original', h), o) for h, o in state.get('originals', {}).items() if h in used)
+    return rows
+
+def project_state(rows):
+    """Inverse of project_rows"""
+    state = {'storyboard': [], 'characters': [], 'scene_images': {}, 'scene_refs': {}, 'originals': {}}
+    by_kind = {}
+    for (kind, key), value in rows.items():
+        by_kind.setdefault(kind, {})[key] = value
+    state.update(by_kind.get('meta', {}))
+    state['storyboard'] = [v for _, v in sorted(by_kind.get('scene', {}).items(), key=lambda kv: int(kv[0]))]
+    state['characters'] = [v for _, v in sorted(by_kind.get('character', {}).items(), key=lambda kv: int(kv[0]))]
+    state['scene_images'] = by_kind.get('image', {})
+    state['scene_refs'] = by_kind.get('refs', {})
+    state['originals'] = by_kind.get('original', {})
+    return state
+
+def row_blobs(kind, key, value):
+    """Blob hashes a project row refers to"""
+    if kind in ('image', 'original'):
+        return [value]
+    if kind == 'character':
+        return [value['preview']] if value.get('preview') else []
+    if kind == 'refs' or (kind == 'meta' and key == 'style_images'):
+        return [r['hash'] for r in value]
+    return []
+
+class ProjectStore:
+    """
+    Durable projects: SQLite rows plus a content-addressed blob directory.
+    A project is stored as the rows of project_rows(). save() compares every row with the
+    copy it last wrote and only writes (and copies blobs for) the rows that changed, so an
+    autosave after a prompt edit is one small UPDATE. load() returns hashes only; images
+    stay on disk until a BlobStore with `blob_dir` as a source asks for them.
+    """
+
+    def __init__(self, path=PROJECT_DB, blob_dir=PROJECT_BLOB_DIR):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.makedirs(blob_dir, exist_ok=True)
+        self.blob_dir = blob_dir
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS projects (id TEXT PRIMARY KEY, name TEXT, created REAL, updated REAL);
+            CREATE TABLE IF NOT EXISTS rows (
+                project TEXT, kind TEXT, key TEXT, value TEXT,
+                PRIMARY KEY (project, kind, key)
+            ) WITHOUT ROWID;
+        """)
+        self.saved = {}  # project id -> {(kind, key): copy of the value as last written}
+
+    def exists(self, project_id):
+        with self.lock:
+            return self.db.execute("SELECT 1 FROM projects WHERE id = ?", (project_id,)).fetchone() is not None
+
+    def projects(self):
+        """[{'id', 'name', 'updated', 'scenes'}], most recently saved first"""
+        with self.lock:
+            cur = self.db.execute("""
+                SELECT p.id, p.name, p.updated,
+                       (SELECT COUNT(*) FROM rows r WHERE r.project = p.id AND r.kind = 'scene')
+                FROM projects p ORDER BY p.updated DESC
+            """)
+            return [{'id': i, 'name': n, 'updated': u, 'scenes': s} for i, n, u, s in cur.fetchall()]
+
+    def rename(self, project_id, name):
+        with self.lock:
+            self.db.execute("UPDATE projects SET name = ? WHERE id = ?", (name, project_id))
+
+    def load(self, project_id):
+        """Project state (blob hashes only), or None if there is no such project"""
+        if not self.exists(project_id):
+            return None
+        with self.lock:
+            cur = self.db.execute("SELECT kind, key, value FROM rows WHERE project = ?", (project_id,))
+            rows = {(kind, key): json.loads(value) for kind, key, value in cur.fetchall()}
+            self.saved[project_id] = {k: json.loads(json.dumps(v)) for k, v in rows.items()}
+        return project_state(rows)
+
+    def save(self, project_id, state, store):
+        """
+        Write the rows of `state` that changed since the last save or load; blobs they refer
+        to are copied from `store` into blob_dir. The project is created by its first save.
+        Returns the number of rows written or deleted.
+        """
+        rows = project_rows(state)
+        with self.lock:
+            saved = self.saved.setdefault(project_id, {})
+            changed = [(k, v) for k, v in rows.items() if k not in saved or saved[k] != v]
+            removed = [k for k in saved if k not in rows]
+            if not changed and not removed:
+                return 0
+            for (kind, key), value in changed:
+                for h in row_blobs(kind, key, value):
+                    self._save_blob(h, store)
+            encoded = [(project_id, kind, key, json.dumps(value, ensure_ascii=False)) for (kind, key), value in changed]
+            now = time.time()
+            self.db.execute("BEGIN")
+            try:
+                self.db.execute("INSERT OR IGNORE INTO projects VALUES (?, ?, ?, ?)",
+                                (project_id, time.strftime("Untitled %Y-%m-%d %H:%M"), now, now))
+                self.db.executemany("INSERT OR REPLACE INTO rows VALUES (?, ?, ?, ?)", encoded)
+                self.db.executemany("DELETE FROM rows WHERE project = ? AND kind = ? AND key = ?",
+                                    [(project_id, kind, key) for kind, key in removed])
+                self.db.execute("UPDATE projects SET updated = ? WHERE id = ?", (now, project_id))
+                self.db.execute("COMMIT")
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+            for (_, kind, key, text) in encoded:
+                saved[(kind, key)] = json.loads(text)
+            for k in removed:
+                del saved[k]
+        return len(changed) + len(removed)
+
+    def _save_blob(self, h, store):
+        path = os.path.join(self.blob_dir, h[:2], h)
+        if os.path.exists(path):
+            return
+        try:
+            data = store.get(h, remember=False)
+        except KeyError:
+            return  # Already gone; the row still records the hash
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+# ==============================================================================
+# 3. HEADLESS PIPELINE (style -> breakdown -> characters -> scenes -> export)
+# ==============================================================================
+
+def load_reference(store, path, max_edge=REF_MAX_EDGE):
+    """Normalize an image file into the blob store, returns a {'hash', 'mime'} ref"""
+    with open(path, 'rb') as f:
+        data = f.read()
+    mime, _ = detect_image_type(data)
+    norm, norm_mime = normalize_reference(data, mime, max_edge)
+    return {'hash': store.put(norm), 'mime': norm_mime}
+
+def iter_breakdown_chunks(client, keys, cache, work, concurrency=BREAKDOWN_CONCURRENCY, owner=None):
+    """Run breakdown_chunk over {n: (payload, units)} on a worker pool, yields (n, data, error) as chunks finish"""
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        futures = {pool.submit(breakdown_chunk, client, keys, cache, payload, units, owner): n
+                   for n, (payload, units) in work.items()}
+        for fut in as_completed(futures):
+            data, err = fut.result()
+            yield futures[fut], data, err
+
+def breakdown_script(client, keys, store, text, style_prompt, instructions="", style_images=(),
+                     cache=None, chunked=True, owner=None):
+    """
+    Break a whole script down into scenes and characters. Returns (data, units).
+    Raises GeminiError if any chunk fails.
+    """
+    units = split_script_units(text)
+    jobs = chunk_units(units) if chunked else [("", units)]
+    work = {
+        n: (build_breakdown_payload(chunk, style_prompt, instructions, style_images, store, context), chunk)
+        for n, (context, chunk) in enumerate(jobs)
+    }
+    results = [None] * len(jobs)
+    for n, data, err in iter_breakdown_chunks(client, keys, cache, work, owner=owner):
+        if data is None:
+            raise GeminiError(f"Chunk {n+1}/{len(jobs)}: {err}")
+        results[n] = data
+    return merge_breakdowns(results), units
+
+@METRICS.timed('build_payload', kind='char_preview')
+def build_char_preview_payload(char, style_prompt, style_images, store):
+    """Image request for a character's look-dev shot, with the global style images"""
+    prompt = f"**Force 16:9 landscape. Copy style from reference.** Cinematic shot of {char['description']}, Style: {style_prompt}"
+
+    parts = [{"text": prompt}]
+    # Add global style images
+    for img in style_images:
+        parts.append(store.part(img['hash'], img['mime']))
+
+    return {
+        "contents": [{"parts": parts}],
+        "generationConfig": {"responseModalities": ["IMAGE"]}
+    }
+
+def generate_char_previews(client, keys, store, characters, style_prompt, style_images,
+                           cache=None, workers=BATCH_CONCURRENCY, processor=None, originals=None, owner=None):
+    """
+    Fill in each character's 'preview' blob hash (in parallel). With a `processor` the preview
+    is the working copy and {working hash: original hash} goes into `originals`.
+    Returns [(key, error)] for the failures.
+    """
+    def work(char):
+        res, err = client.post(build_char_preview_payload(char, style_prompt, style_images, store),
+                               "image-preview", keys, cache, owner=owner)
+        data = extract_image(res)
+        if data:
+            if processor:
+                char['preview'], original = processor.ingest(store, data)
+                if original != char['preview'] and originals is not None:
+                    originals[char['preview']] = original
+            else:
+                char['preview'] = store.put(data)
+            return None
+        return char['key'], err or "No image returned"
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        return [e for e in pool.map(work, characters) if e]
+
+def build_scene_spec(scene, style_prompt, characters, style_images, scene_refs=(), keys=None):
+    """
+    Scene spec for build_image_payload. Only the characters the prompt references as [Name]
+    are included (`keys`: their normalized keys, e.g. from a CharacterIndex; parsed from the
+    prompt if None). References, in order:
+    1. Global Style Images
+    2. Preview images of the referenced characters
+    3. Scene Specific Uploaded References
+    """
+    if keys is None:
+        keys = prompt_char_keys(scene['prompt'])
+    by_key = {normalize_char_key(c['key']): c for c in characters}
+    cast = [by_key[k] for k in keys if k in by_key]
+
+    # 1. Build Context String
+    char_context = "\n".join([f"{c['key']}: {c['description']}" for c in cast])
+    locked = [c for c in cast if c.get('preview')]
+
+    # 2. Build Prompt (React logic)
+    final_prompt = f"""
+        **FORCE 16:9 LANDSCAPE.** Copy style from reference images.
+        STYLE: {style_prompt}
+        CONTEXT: {char_context}
+        SCENE: {scene['prompt']}
+        """
+
+    if locked:
+        final_prompt += f"\nCHARACTER REFERENCES: after the style images come the locked looks of {', '.join(c['key'] for c in locked)}, in that order."
+    if scene_refs:
+        final_prompt += f"\nCRITICAL: Use the provided scene-specific images as key visual references."
+
+    # 3. Payload refs: A. Global Style Refs, B. Character Previews, C. Scene Specific Refs
+    refs = [{'hash': r['hash'], 'mime': r['mime']} for r in style_images]
+    refs += [{'hash': c['preview'], 'mime': None} for c in locked]   # Mime read from the blob (PNG, WEBP...)
+    refs += [{'hash': r['hash'], 'mime': r['mime']} for r in scene_refs]
+
+    return {'model': "image-preview", 'text': final_prompt, 'refs': refs}
+
+def plan_scene_jobs(indices, spec_for, scene_images, mode):
+    """
+    JobQueue jobs for the scenes in `indices`, in plan_batch_waves order. `spec_for(index)`
+    builds a scene spec; existing `scene_images` provide continuity for the first wave.
+    """
+    jobs = []
+    for wave in plan_batch_waves(indices, scene_images.keys(), mode):
+        for i, prev in wave:
+            jobs.append({
+                'index': i, 'spec': spec_for(i), 'prev_index': prev,
+                'prev': scene_images.get(str(prev)) if prev is not None else None,
+            })
+    return jobs
+
+def write_output_dir(out_dir, store, scene_images, storyboard, characters, style_prompt, contact_sheet=None,
+                     originals=None):
+    """
+    Write a storyboard as plain files: scene_N.<ext>, characters/<name>.<ext>, manifest.json
+    and optional contact sheet pages ('png' or 'pdf'). Images are written as their
+    `originals` where known (see write_zip_export).
+    """
+    originals = originals or {}
+    os.makedirs(out_dir, exist_ok=True)
+    entries, files, char_files = [], {}, {}
+    for idx in sorted(scene_images, key=int):
+        h = scene_images[idx]
+        data = store.get(originals.get(h, h), remember=False)
+        _, ext = detect_image_type(data)
+        name = f"scene_{int(idx)+1}{ext}"
+        with open(os.path.join(out_dir, name), 'wb') as f:
+            f.write(data)
+        entries.append((f"Scene {int(idx)+1}", scene_images[idx]))
+        files[int(idx)] = name
+
+    for c in characters:
+        if not c.get('preview'):
+            continue
+        data = store.get(originals.get(c['preview'], c['preview']), remember=False)
+        _, ext = detect_image_type(data)
+        slug = re.sub(r'[^a-z0-9]+', '_', normalize_char_key(c['key'])).strip('_') or "character"
+        name = f"characters/{slug}{ext}"
+        os.makedirs(os.path.join(out_dir, "characters"), exist_ok=True)
+        with open(os.path.join(out_dir, name), 'wb') as f:
+            f.write(data)
+        char_files[c['key']] = name
+
+    if contact_sheet == 'png':
+        for n, page in enumerate(iter_contact_sheet_pages(store, entries), start=1):
+            page.save(os.path.join(out_dir, f"contact_sheet_{n:02d}.png"), 'PNG', optimize=True)
+    elif contact_sheet == 'pdf' and entries:
+        pdf_path = os.path.join(out_dir, "contact_sheet.pdf")
+        for n, page in enumerate(iter_contact_sheet_pages(store, entries)):
+            page.save(pdf_path, 'PDF', resolution=96, append=n > 0)
+
+    doc = build_manifest(storyboard, characters, style_prompt, files, char_files)
+    with open(os.path.join(out_dir, "manifest.json"), 'w', encoding='utf-8') as f:
+        json.dump(doc, f, indent=2, ensure_ascii=False)
+    return doc
+
+def produce_storyboard(client, keys, store, queue, script_text, out_dir, style_prompt="", style_images=(),
+                       instructions="", cache=None, chunked=True, previews=True, images=True,
+                       mode='alternate', workers=BATCH_CONCURRENCY, contact_sheet=None, zip_export=False,
+                       log=None, processor=None, owner="cli"):
+    """
+    Whole pipeline for one script, written to `out_dir`. Scene images go through the
+    JobQueue `queue`, so several scripts produced at once share its workers, the client's
+    rate limiter and the key pool; with a QuotaGovernor on the client, scripts (`owner`)
+    take turns. Returns the manifest, plus an 'errors' list.
+    """
+    log = log or (lambda msg: None)
+    errors, originals = [], {}
+
+    data, _ = breakdown_script(client, keys, store, script_text, style_prompt, instructions,
+                               style_images, cache, chunked, owner)
+    storyboard, characters = data['storyboard'], data['characters']
+    log(f"{len(storyboard)} scenes, {len(characters)} characters")
+
+    if previews and characters:
+        failed = generate_char_previews(client, keys, store, characters, style_prompt, style_images, cache, workers,
+                                        processor, originals, owner)
+        errors.extend(f"Character {key}: {err}" for key, err in failed)
+        log(f"{len(characters) - len(failed)}/{len(characters)} character previews")
+
+    scene_images = {}
+    if images and storyboard:
+        spec_for = lambda i: build_scene_spec(storyboard[i], style_prompt, characters, style_images)
+        jobs = plan_scene_jobs(range(len(storyboard)), spec_for, scene_images, mode)
+        batch_id = queue.submit(owner, os.path.basename(out_dir), jobs, keys, cache, workers)
+        for job in queue.wait(batch_id):
+            if job['state'] == 'done':
+                scene_images[str(job['index'])] = job['result']
+                if job.get('original') and job['original'] != job['result']:
+                    originals[job['result']] = job['original']
+            else:
+                errors.append(f"Scene {job['index']+1}: {job['error'] or job['state']}")
+        log(f"{len(scene_images)}/{len(storyboard)} scene images")
+
+    doc = write_output_dir(out_dir, store, scene_images, storyboard, characters, style_prompt, contact_sheet, originals)
+    if zip_export:
+        with open(os.path.join(out_dir, "storyboard.zip"), 'wb') as f:
+            write_zip_export(f, store, scene_images, storyboard, characters, style_prompt, contact_sheet,
+                             originals=originals)
+    doc['errors'] = errors
+    return doc
+
+# ==============================================================================
+# 4. COMMAND LINE
+# ==============================================================================
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="scenebuilder",
+        description="Headless storyboard production: breaks scripts down into scenes and renders them."
+    )
+    parser.add_argument("scripts", nargs="+", help="Script text files (one storyboard per file)")
+    parser.add_argument("-o", "--out", default="storyboards", help="Output directory (one sub-directory per script)")
+    parser.add_argument("--style", default="", help="Style prompt")
+    parser.add_argument("--style-file", help="Read the style prompt from a file")
+    parser.add_argument("--refs", nargs="*", default=[], help="Style reference images")
+    parser.add_argument("--instructions", default="", help="Extra breakdown instructions")
+    parser.add_argument("--api-key", action="append", default=[],
+                        help="Gemini API key (repeatable). Defaults to $GEMINI_API_KEYS (comma separated)")
+    parser.add_argument("--jobs", type=int, default=1, help="Scripts produced in parallel")
+    parser.add_argument("--workers", type=int, default=BATCH_CONCURRENCY, help="Parallel image requests per script")
+    parser.add_argument("--continuity", choices=sorted(CONTINUITY_MODES), default='alternate')
+    parser.add_argument("--single-request", action="store_true", help="Break each script down in one request instead of chunks")
+    parser.add_argument("--no-previews", action="store_true", help="Skip character previews")
+    parser.add_argument("--no-images", action="store_true", help="Only break the scripts down")
+    parser.add_argument("--contact-sheet", choices=['png', 'pdf'])
+    parser.add_argument("--zip", action="store_true", help="Also write storyboard.zip")
+    parser.add_argument("--cache", action="store_true", help="Reuse cached responses for identical requests")
+    parser.add_argument("--max-edge", type=int, default=REF_MAX_EDGE, help="Reference images are downscaled to this")
+    parser.add_argument("--postprocess-workers", type=int, default=POSTPROCESS_WORKERS,
+                        help="Processes that fit generated images to 16:9 and make working copies (0 = inline)")
+    parser.add_argument("--metrics-out", help="Write request/processing metrics as JSON lines to this file")
+    parser.add_argument("--metrics-port", type=int, default=METRICS_PORT, help="Serve Prometheus metrics while running")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    keys = args.api_key or [k.strip() for k in os.environ.get("GEMINI_API_KEYS", os.environ.get("GEMINI_API_KEY", "")).split(",") if k.strip()]
+    if not keys:
+        print("API Key required: pass --api-key or set GEMINI_API_KEYS.", file=sys.stderr)
+        return 2
+
+    if args.metrics_port:
+        serve_metrics(args.metrics_port)
+
+    style_prompt = args.style
+    if args.style_file:
+        with open(args.style_file, 'r', encoding='utf-8') as f:
+            style_prompt = f.read().strip()
+
+    # One client, key pool, blob store and job queue for every script, so rate limits hold globally
+    client, pool, store = GeminiClient(governor=QuotaGovernor()), ApiKeyPool(keys), BlobStore()
+    processor = ImageProcessor(args.postprocess_workers)
+    queue = JobQueue(client, store, directory=os.path.join(args.out, ".jobs"), processor=processor)
+    cache = ResponseCache() if args.cache else None
+    style_images = [load_reference(store, p, args.max_edge) for p in args.refs]
+
+    def run(path):
+        name = os.path.splitext(os.path.basename(path))[0]
+        log = lambda msg: print(f"[{name}] {msg}", file=sys.stderr, flush=True)
+        with open(path, 'r', encoding='utf-8') as f:
+            text = f.read()
+        doc = produce_storyboard(
+            client, pool, store, queue, text, os.path.join(args.out, name), style_prompt, style_images,
+            args.instructions, cache, chunked=not args.single_request, previews=not args.no_previews,
+            images=not args.no_images, mode=args.continuity, workers=args.workers,
+            contact_sheet=args.contact_sheet, zip_export=args.zip, log=log, processor=processor, owner=name
+        )
+        for err in doc['errors']:
+            log(err)
+        return not doc['errors']
+
+    failed = 0
+    with ThreadPoolExecutor(max_workers=max(1, args.jobs)) as executor:
+        futures = {executor.submit(run, p): p for p in args.scripts}
+        for fut in as_completed(futures):
+            try:
+                ok = fut.result()
+            except Exception as e:
+                print(f"[{futures[fut]}] {type(e).__name__}: {e}", file=sys.stderr)
+                ok = False
+            failed += not ok
+
+    for row in METRICS.summary():
+        print(" · ".join(f"{k} {v}" for k, v in row.items()), file=sys.stderr)
+    if args.metrics_out:
+        with open(args.metrics_out, 'w', encoding='utf-8') as f:
+            f.write(METRICS.jsonl())
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,23 @@
+import os
+
+from scenebuilder_core import BlobStore
+
+def files(directory):
+    return sum(len(names) for _, _, names in os.walk(directory))
+
+def test_spill_directory_is_capped_lru(tmp_path):
+    store = BlobStore(str(tmp_path), memory_limit=250, disk_limit=1000)
+    hashes = [store.put(bytes([i]) * 200) for i in range(10)]
+    assert store.disk_size <= 1000 and files(tmp_path) == len(store.disk)
+    assert store.get(hashes[-1]) == bytes([9]) * 200           # Newest: still in memory
+    assert hashes[0] not in store                              # Oldest: evicted
+    # The index is rebuilt from disk
+    assert BlobStore(str(tmp_path), disk_limit=1000).disk_size == store.disk_size
+
+def test_persisted_blobs_are_never_evicted(tmp_path):
+    store = BlobStore(str(tmp_path), memory_limit=250, disk_limit=1000)
+    kept = store.put(b'k' * 200, cold=True)
+    store.persist(kept)
+    for i in range(20):
+        store.put(bytes([i]) * 200)
+    assert store.get(kept, remember=False) == b'k' * 200
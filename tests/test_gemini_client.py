@@ -0,0 +1,105 @@
+"""GeminiClient against the local mock server from bench/ (retries, Retry-After, key rotation)"""
+import random
+import time
+
+import pytest
+import requests
+
+import scenebuilder_core as core
+from mock_gemini import MockConfig, MockGemini
+
+PAYLOAD = {'contents': [{'parts': [{'text': "Describe a rainy street"}]}]}
+RPM = {'flash-preview': 100000, 'image-preview': 100000}   # Client-side limits out of the way
+
+@pytest.fixture
+def mock():
+    server = MockGemini(MockConfig(latency=0, jitter=0)).start()
+    yield server
+    server.stop()
+
+@pytest.fixture(autouse=True)
+def fast_backoff(monkeypatch):
+    monkeypatch.setattr(core, 'BACKOFF_BASE', 0.01)
+
+def statuses(mock):
+    return mock.stats()['statuses']
+
+def test_success(mock):
+    res, err = core.GeminiClient(mock.base_url).post(PAYLOAD, 'flash-preview', core.ApiKeyPool(['k1'], RPM))
+    assert err is None and core.response_text(res)
+    assert statuses(mock) == {200: 1}
+
+def test_retries_server_errors_until_success(mock):
+    # A seed whose first draw fails the request and second lets it through
+    def draws(seed):
+        rng = random.Random(seed)
+        return [rng.random() < 0.5 for _ in range(2)]
+    mock.config.error_rate, mock.rng = 0.5, random.Random(next(s for s in range(100) if draws(s) == [True, False]))
+    res, err = core.GeminiClient(mock.base_url).post(PAYLOAD, 'flash-preview', core.ApiKeyPool(['k1'], RPM))
+    assert err is None and res
+    assert statuses(mock) == {503: 1, 200: 1}
+
+def test_gives_up_after_max_retries(mock):
+    mock.config.error_rate = 1.0
+    res, err = core.GeminiClient(mock.base_url).post(PAYLOAD, 'flash-preview', core.ApiKeyPool(['k1'], RPM))
+    assert res is None and err.startswith("API Error 503")
+    assert statuses(mock) == {503: core.MAX_RETRIES + 1}
+
+def test_rate_limited_key_is_swapped_without_backoff(mock):
+    mock.config.rpm = 1
+    # Use up k1's quota at the mock, so the client's first pick gets a 429
+    requests.post(f"{mock.base_url}/models/{core.MODELS['flash-preview']}:generateContent",
+                  json=PAYLOAD, headers={'x-goog-api-key': 'k1'})
+    keys = core.ApiKeyPool(['k1', 'k2'], RPM)
+    start = time.monotonic()
+    res, err = core.GeminiClient(mock.base_url).post(PAYLOAD, 'flash-preview', keys)
+    assert err is None and res
+    assert time.monotonic() - start < 1
+    assert statuses(mock) == {200: 2, 429: 1}
+    k1, k2 = keys.snapshot()
+    assert k1['errors'] == 1 and k1['cooldown'] > 0
+    assert k2['errors'] == 0 and k2['cooldown'] == 0
+
+def test_retry_after_is_honoured(mock, monkeypatch):
+    monkeypatch.setattr(core, 'KEY_COOLDOWN', {429: 60, 403: 300})
+    mock.config.rpm, mock.config.window = 1, 0.5
+    keys = core.ApiKeyPool(['k1'], RPM)
+    client = core.GeminiClient(mock.base_url)
+    assert client.post(PAYLOAD, 'flash-preview', keys)[1] is None
+    # The only key gets a 429 with Retry-After ~0.5 s: the client waits that long (not the 60 s
+    # default cooldown) and the retry goes through once the mock's window has moved on
+    start = time.monotonic()
+    res, err = client.post(PAYLOAD, 'flash-preview', keys)
+    assert err is None and res
+    assert 0.4 < time.monotonic() - start < 5
+    assert statuses(mock) == {200: 2, 429: 1}
+
+def test_fails_fast_when_no_key_is_usable_in_time(mock):
+    keys = core.ApiKeyPool(['k1'], RPM)
+    client = core.GeminiClient(mock.base_url)
+    keys.report_error('k1', 429, "API Error 429", retry_after=core.KEY_WAIT_TIMEOUT + 30)
+    start = time.monotonic()
+    res, err = client.post(PAYLOAD, 'flash-preview', keys)
+    assert res is None and err.startswith("No API key available")
+    assert time.monotonic() - start < 1
+    assert statuses(mock) == {}
+
+def test_forbidden_keys_fail_fast(mock):
+    keys = core.ApiKeyPool(['k1', 'k2'], RPM)
+    for key in ('k1', 'k2'):
+        keys.report_error(key, 403, "API Error 403: key revoked")
+    res, err = core.GeminiClient(mock.base_url).post(PAYLOAD, 'flash-preview', keys)
+    assert res is None and "key revoked" in err
+
+def test_invalid_json_is_an_error(monkeypatch):
+    class Truncated:
+        def json(self):
+            raise ValueError("Expecting value: line 1 column 1 (char 0)")
+    client = core.GeminiClient("http://unused")
+    monkeypatch.setattr(client, '_request', lambda *a, **kw: (Truncated(), None))
+    res, err = client.post(PAYLOAD, 'flash-preview', core.ApiKeyPool(['k1'], RPM))
+    assert res is None and err.startswith("Invalid JSON response")
+
+def test_backoff_never_shorter_than_retry_after():
+    assert all(core.backoff_delay(attempt, retry_after=2.0) >= 2.0 for attempt in range(5))
+    assert all(0 <= core.backoff_delay(attempt) <= core.BACKOFF_CAP for attempt in range(10))
@@ -0,0 +1,70 @@
+import base64
+import threading
+
+from scenebuilder_core import ApiKeyPool, BlobStore, JobQueue, plan_scene_jobs
+
+class StubClient:
+    """Answers every image request with a tiny 'image' naming the prompt, and records the calls"""
+
+    def __init__(self):
+        self.calls = []
+        self.fail = set()   # Prompts answered with an error
+        self.lock = threading.Lock()
+
+    def post(self, payload, model, keys, cache=None, force=False, owner=None):
+        parts = payload['contents'][0]['parts']
+        text = parts[0]['text'].split(' (')[0]
+        with self.lock:
+            self.calls.append((text, len(parts) > 1))
+        if text in self.fail:
+            return None, "API Error 500: boom"
+        data = base64.b64encode(b'\x89PNG\r\n\x1a\n' + text.encode()).decode('ascii')
+        return {'candidates': [{'content': {'parts': [{'inlineData': {'mimeType': 'image/png', 'data': data}}]}}]}, None
+
+def spec_for(i):
+    return {'model': 'image-preview', 'text': f"scene {i}", 'refs': []}
+
+def make_queue(tmp_path, threads=4):
+    client = StubClient()
+    return client, JobQueue(client, BlobStore(str(tmp_path / "blobs")), directory=str(tmp_path / "jobs"), threads=threads)
+
+def test_chain_batch_runs_in_order_with_continuity(tmp_path):
+    client, queue = make_queue(tmp_path)
+    jobs = plan_scene_jobs(range(4), spec_for, {}, 'chain')
+    done = queue.wait(queue.submit("me", "test", jobs, ApiKeyPool(['k'])))
+    assert [j['state'] for j in done] == ['done'] * 4
+    assert client.calls == [("scene 0", False), ("scene 1", True), ("scene 2", True), ("scene 3", True)]
+
+def test_interrupted_batch_is_offered_to_its_project_only(tmp_path):
+    _, queue = make_queue(tmp_path, threads=0)
+    batch_id = queue.submit("me", "test", plan_scene_jobs(range(3), spec_for, {}, 'off'), ApiKeyPool(['k']),
+                            project="p1")
+    assert [b['active'] for b in queue.unfinished_batches("p1")] == [True]
+    # After a restart the journal is replayed; nobody is running the batch any more
+    client, queue = make_queue(tmp_path)
+    assert [(b['id'], b['active']) for b in queue.unfinished_batches("p1")] == [(batch_id, False)]
+    assert queue.unfinished_batches("p2") == []
+    queue.resume(batch_id, "me again", ApiKeyPool(['k']))
+    assert [j['state'] for j in queue.wait(batch_id)] == ['done'] * 3
+    assert queue.unfinished_batches("p1") == []
+
+def test_finished_batch_lets_go_of_its_keys(tmp_path):
+    client, queue = make_queue(tmp_path)
+    client.fail.add("scene 1")
+    batch_id = queue.submit("me", "test", plan_scene_jobs(range(3), spec_for, {}, 'off'), ApiKeyPool(['k']),
+                            project="p1")
+    assert [j['state'] for j in queue.wait(batch_id)] == ['done', 'failed', 'done']
+    assert not queue.is_active(batch_id) and batch_id not in queue.runtime
+    assert [b['active'] for b in queue.unfinished_batches("p1")] == [False]
+    client.fail.clear()
+    queue.retry_failed(batch_id, "me", ApiKeyPool(['k']))
+    assert [j['state'] for j in queue.wait(batch_id)] == ['done'] * 3
+    assert not queue.is_active(batch_id)
+
+def test_in_flight_lists_queued_scenes_of_active_batches(tmp_path):
+    _, queue = make_queue(tmp_path, threads=0)
+    batch_id = queue.submit("me", "test", plan_scene_jobs([2, 3], spec_for, {}, 'off'), ApiKeyPool(['k']),
+                            project="p1")
+    assert queue.in_flight("p1") == {2, 3} and queue.in_flight("p2") == set()
+    queue.cancel(batch_id)
+    assert queue.in_flight("p1") == set() and not queue.is_active(batch_id)
@@ -0,0 +1,64 @@
+from scenebuilder_core import CharacterIndex, StoryboardStreamParser, plan_batch_waves, plan_incremental_breakdown
+
+# --- plan_batch_waves ---
+def test_waves_off_is_one_parallel_wave():
+    assert plan_batch_waves([2, 0, 1], {}, 'off') == [[(0, None), (1, None), (2, None)]]
+    assert plan_batch_waves([], {}, 'off') == []
+
+def test_waves_chain_waits_for_previous_scene():
+    assert plan_batch_waves([0, 1, 2], {}, 'chain') == [[(0, None)], [(1, 0)], [(2, 1)]]
+
+def test_waves_alternate_keyframes_then_between():
+    assert plan_batch_waves([0, 1, 2, 3, 4], {}, 'alternate') == [[(0, None), (2, None), (4, None)], [(1, 0), (3, 2)]]
+
+def test_waves_alternate_uses_generated_scene_keys_as_ints():
+    # scene_images keys are strings; scene 1 already has an image, so scene 2 continues from it
+    assert plan_batch_waves([2, 3, 4], {'1': 'h'}, 'alternate') == [[(2, 1), (4, None)], [(3, 2)]]
+
+# --- StoryboardStreamParser ---
+BREAKDOWN = ('{"storyboard": [{"script": "He says \\"hi {there}\\"", "prompt": "[Bob] waves"}, '
+             '{"script": "b", "prompt": "[Bob] sits", "part": 2}], '
+             '"characters": [{"key": "[Bob]", "description": "{not a scene}"}]}')
+
+def test_stream_parser_yields_each_scene_once_complete():
+    parser, items = StoryboardStreamParser(), []
+    for i in range(0, len(BREAKDOWN), 7):
+        items.extend(parser.feed(BREAKDOWN[i:i + 7]))
+    assert [s['prompt'] for s in items] == ["[Bob] waves", "[Bob] sits"]
+    assert items[0]['script'] == 'He says "hi {there}"'
+    assert parser.text == BREAKDOWN
+
+def test_stream_parser_waits_for_closing_brace():
+    parser = StoryboardStreamParser()
+    cut = BREAKDOWN.index('"}, {') + 1   # The first scene's closing brace
+    assert parser.feed(BREAKDOWN[:cut]) == []
+    assert len(parser.feed(BREAKDOWN[cut:cut + 1])) == 1
+
+# --- plan_incremental_breakdown ---
+def test_incremental_keeps_unchanged_passages():
+    storyboard = [{'prompt': 'a1', 'src': 'a'}, {'prompt': 'a2', 'src': 'a'}, {'prompt': 'b1', 'src': 'b'},
+                  {'prompt': 'c1', 'src': 'c'}]
+    assert plan_incremental_breakdown(['a', 'b', 'c'], storyboard, ['a', 'x', 'y', 'c']) == [
+        ('keep', [0, 1]), ('new', 1, 3), ('keep', [3])]
+
+def test_incremental_drops_removed_passages():
+    storyboard = [{'prompt': 'a1', 'src': 'a'}, {'prompt': 'b1', 'src': 'b'}]
+    assert plan_incremental_breakdown(['a', 'b'], storyboard, ['a']) == [('keep', [0])]
+
+# --- CharacterIndex ---
+def test_character_rename_rewrites_prompts_and_index():
+    storyboard = [{'prompt': "[Bob] waves at [Alice]"}, {'prompt': "[Alice] alone"}, {'prompt': "[ bob ] sits"}]
+    index = CharacterIndex().sync(storyboard)
+    assert index.scenes_for('[Bob]') == [0, 2]
+    assert index.rename(storyboard, '[Bob]', 'Robert') == [0, 2]
+    assert [s['prompt'] for s in storyboard] == ["[Robert] waves at [Alice]", "[Alice] alone", "[Robert] sits"]
+    assert index.scenes_for('[Bob]') == [] and index.scenes_for('[Robert]') == [0, 2]
+    assert index.scenes_for('[Alice]') == [0, 1]
+
+def test_incremental_keeps_hand_added_scenes_of_changed_passages():
+    storyboard = [{'prompt': 'a1', 'src': 'a'}, {'prompt': 'b1', 'src': 'b'}, {'prompt': 'by hand'},
+                  {'prompt': 'c1', 'src': 'c'}]
+    assert plan_incremental_breakdown(['a', 'b', 'c'], storyboard, ['a', 'x', 'c']) == [
+        ('keep', [0]), ('new', 1, 2), ('keep', [2]), ('keep', [3])]
+    assert plan_incremental_breakdown(['a', 'b', 'c'], storyboard, ['a', 'c']) == [
+        ('keep', [0]), ('keep', [2]), ('keep', [3])]